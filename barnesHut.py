@@ -0,0 +1,382 @@
+import time
+import numpy as np
+from forces import directAccelerations, threadPool
+
+#Number of bits per axis used in the Morton keys (3*21 = 63 bits fit in an uint64), which is also the maximum depth of the tree
+MORTON_BITS = 21
+
+#Number of bodies whose interactions are traversed at once (bounds the size of the interaction lists)
+BODIES_PER_CHUNK = 4096
+
+#Largest number of bodies of the groups that walk the tree together and share one interaction list (consecutive bodies in the Morton order inside
+#one node of the tree with at most GROUP_NODE_SIZE bodies)
+GROUP_SIZE = 32
+GROUP_NODE_SIZE = 128
+
+#Maximum number of interactions evaluated at once from the interaction lists (as PAIRS_PER_BLOCK of the direct kernel)
+PAIRS_PER_BATCH = 2**16
+
+def _spreadBits(values):
+    """ Inserts two zero bits between each of the 21 lowest bits of the given integers"""
+    x = values.astype(np.uint64) & np.uint64(0x1fffff)
+    x = (x | x << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    x = (x | x << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    x = (x | x << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    x = (x | x << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | x << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return x
+
+def _ranges(starts, counts):
+    """ Concatenates the integer ranges [start, start+count) and returns them together with the index of the range each element came from"""
+    owner = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(owner.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets, owner
+
+class Octree():
+    """
+    Array-backed octree built from the Morton (Z-order) keys of the bodies. Every node is stored as one entry of flat NumPy arrays, and the bodies of a node are always a contiguous slice of the sorted body arrays.
+
+    Takes the following variables as initialization values:
+        - positions: Positions of the bodies
+            array of shape [numOfBodies, 3]
+        - masses: Masses of the bodies
+            array of shape [numOfBodies] or [numOfBodies, 1]
+        - leafSize: Maximum number of bodies kept in a leaf before it is subdivided
+            int
+        - groupSize: Largest number of bodies of the groups that share an interaction list; the groups split the largest nodes with at most
+            max(groupSize, GROUP_NODE_SIZE) bodies into runs of consecutive bodies
+            int
+
+    The interactions are evaluated in the floating point type of the given positions (e.g. float32), but the tree is built in at least float64,
+    since the centers of mass of its nodes come from differences of cumulative sums over all bodies.
+    """
+
+    def __init__(self, positions, masses, leafSize = 8, groupSize = GROUP_SIZE):
+        positions = np.asarray(positions)
+        self.dtype = positions.dtype if np.issubdtype(positions.dtype, np.floating) else np.dtype(float)
+        treeDtype = np.promote_types(self.dtype, np.float64)
+        positions = positions.astype(treeDtype, copy=False)
+        masses = np.asarray(masses, dtype=treeDtype).reshape(-1)
+        self.leafSize = leafSize
+        self.groupSize = groupSize
+
+        #Bounding cube of the system, slightly enlarged so that no body lies exactly on its upper faces
+        lower = positions.min(axis=0)
+        self.rootSize = max(np.max(positions.max(axis=0) - lower), np.finfo(float).tiny) * (1 + 1e-9)
+        self.origin = lower
+
+        cells = np.floor((positions - lower) / self.rootSize * 2**MORTON_BITS)
+        cells = np.clip(cells, 0, 2**MORTON_BITS - 1).astype(np.uint64)
+        keys = _spreadBits(cells[:, 0]) << np.uint64(2) | _spreadBits(cells[:, 1]) << np.uint64(1) | _spreadBits(cells[:, 2])
+
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+        self.positions = positions[self.order]
+        self.masses = masses[self.order]
+
+        self.build()
+
+    def build(self):
+        """ Creates the nodes level by level, subdividing only the nodes with more than leafSize bodies"""
+        levels, prefixes, starts, counts = [], [], [], []
+        active = np.arange(len(self.keys))
+
+        for level in range(MORTON_BITS + 1):
+            prefix = self.keys[active] >> np.uint64(3 * (MORTON_BITS - level))
+            runStarts = np.flatnonzero(np.r_[True, prefix[1:] != prefix[:-1]])
+            runCounts = np.diff(np.r_[runStarts, len(active)])
+
+            levels.append(np.full(len(runStarts), level))
+            prefixes.append(prefix[runStarts])
+            starts.append(active[runStarts])
+            counts.append(runCounts)
+
+            #Only the bodies of the nodes that will be subdivided take part in the next level
+            split = runCounts > self.leafSize
+            active = active[np.repeat(split, runCounts)]
+            if not len(active):
+                break
+
+        self.level = np.concatenate(levels)
+        self.prefix = np.concatenate(prefixes)
+        self.start = np.concatenate(starts)
+        self.count = np.concatenate(counts)
+        self.size = self.rootSize / 2.0**self.level
+        self.isLeaf = (self.count <= self.leafSize) | (self.level == MORTON_BITS)
+
+        #Mass and center of mass of each node from cumulative sums over the sorted bodies
+        cumMass = np.r_[0, np.cumsum(self.masses)]
+        cumMoment = np.vstack([np.zeros(3), np.cumsum(self.masses[:, np.newaxis] * self.positions, axis=0)])
+        end = self.start + self.count
+        self.mass = cumMass[end] - cumMass[self.start]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.com = (cumMoment[end] - cumMoment[self.start]) / self.mass[:, np.newaxis]
+        massless = ~(self.mass > 0)
+        self.com[massless] = (self.positions[self.start[massless]] + self.positions[end[massless] - 1]) / 2
+
+        #Children of every internal node are contiguous in the following level
+        self.childStart = np.zeros(len(self.level), dtype=int)
+        self.childCount = np.zeros(len(self.level), dtype=int)
+        self.parent = np.full(len(self.level), -1)
+        offset = 0
+        for level in range(len(levels) - 1):
+            parents = np.arange(offset, offset + len(levels[level]))
+            children = np.arange(parents[-1] + 1, parents[-1] + 1 + len(levels[level + 1]))
+            owner = parents[np.searchsorted(self.prefix[parents], self.prefix[children] >> np.uint64(3))]
+            self.childCount += np.bincount(owner, minlength=len(self.level))
+            first = np.r_[True, owner[1:] != owner[:-1]]
+            self.childStart[owner[first]] = children[first]
+            self.parent[children] = owner
+            offset += len(levels[level])
+
+        #Groups: the nodes with at most GROUP_NODE_SIZE bodies whose parent has more hold every body once and are small in space (runs of
+        #consecutive bodies in the Morton order may jump between distant cells), and they are split into runs of at most groupSize bodies.
+        #Each group is enclosed by a sphere
+        nodeSize = max(self.groupSize, GROUP_NODE_SIZE)
+        parentCount = np.where(self.parent >= 0, self.count[self.parent], len(self.keys) + 1)
+        groupNodes = np.flatnonzero((self.count <= nodeSize) & (parentCount > nodeSize))
+        groupNodes = groupNodes[np.argsort(self.start[groupNodes])]
+        numRuns = -(-self.count[groupNodes] // self.groupSize)
+        run, node = _ranges(np.zeros(len(groupNodes), dtype=int), numRuns)
+        self.groupStart = self.start[groupNodes][node] + run * self.groupSize
+        self.groupCount = np.minimum(self.groupSize, self.start[groupNodes][node] + self.count[groupNodes][node] - self.groupStart)
+        self.groupOf = np.repeat(np.arange(len(self.groupStart)), self.groupCount) #group of each body, in the sorted order
+        lower = np.minimum.reduceat(self.positions, self.groupStart)
+        upper = np.maximum.reduceat(self.positions, self.groupStart)
+        self.groupCentre = (lower + upper) / 2
+        self.groupRadius = np.linalg.norm(upper - lower, axis=1) / 2
+
+    def accelerations(self, G, softening = 0, theta = 0.5, targets = None, workers = 1, potential = False):
+        """
+        Calculates the acceleration of every body with the Barnes-Hut approximation.
+
+        Takes the following variables as input:
+            - G: Gravitational constant
+                numerical value as int or float
+            - softening: Plummer softening length
+                numerical value as int or float
+            - theta: Opening angle; a node of size s at a distance d is approximated by its center of mass when s/d < theta (theta = 0 gives the direct sum)
+                numerical value as int or float
+            - targets: Indexes (in the original order) of the bodies whose accelerations are calculated; when not provided, all bodies are used
+                array of int
+            - workers: Number of threads among which the chunks of bodies are distributed
+                int
+            - potential: Whether the potential energy is also calculated from the same interaction lists (-G/2 * sum over the targets i of m_i times the sum of m/r over
+              their sources, which is the total potential energy of the tree when all bodies are targets)
+                bool
+
+        Returns an array of shape [numOfTargets, 3] of the type of the interactions, in the order of the targets (or the original order of the bodies),
+        or a tuple (accelerations, potential energy) when potential is True.
+        """
+        numOfBodies = len(self.masses)
+        if targets is None:
+            groups = np.arange(len(self.groupStart))
+        else:
+            rank = np.empty(numOfBodies, dtype=int)
+            rank[self.order] = np.arange(numOfBodies)
+            bodies = rank[targets]
+            groups = np.unique(self.groupOf[bodies])
+
+        #Consecutive groups with about BODIES_PER_CHUNK bodies in total form a chunk
+        chunkOf = (np.cumsum(self.groupCount[groups]) - 1) // BODIES_PER_CHUNK
+        chunks = np.split(groups, np.flatnonzero(np.diff(chunkOf)) + 1)
+        traverse = lambda chunk: self.chunkAccelerations(chunk, G, softening, theta, potential)
+        mapChunks = threadPool(workers).map if workers > 1 else map
+        sortedAcc = np.zeros((numOfBodies, 3), self.dtype)
+        sortedPhi = np.zeros(numOfBodies) #G * sum of m/r over the sources of each body, when the potential is calculated
+        for chunkBodies, accChunk, phiChunk in mapChunks(traverse, chunks):
+            sortedAcc[chunkBodies] = accChunk
+            if potential:
+                sortedPhi[chunkBodies] = phiChunk
+
+        if targets is not None:
+            accelerations = sortedAcc[bodies]
+        else:
+            bodies = slice(None)
+            accelerations = np.empty_like(sortedAcc)
+            accelerations[self.order] = sortedAcc
+        if potential:
+            return accelerations, -np.sum(self.masses[bodies] * sortedPhi[bodies]) / 2 #cada par foi somado duas vezes
+        return accelerations
+
+    def interactionLists(self, groups, theta):
+        """
+        Walks the tree once for each of the given groups. A node is approximated by its center of mass when it holds no body of the group,
+        and its size is smaller than theta times the distance from its center of mass to the sphere around the group (so the criterion holds for every body of the group).
+
+        Returns the pairs (group, node) of the nodes approximated by their center of mass, and the pairs (group, leaf) of the leaves whose bodies interact directly with the group.
+        """
+        group = np.arange(len(groups))
+        node = np.zeros(len(groups), dtype=int)
+        far, near = [], []
+
+        while len(group):
+            first = self.groupStart[groups[group]]
+            distance = np.linalg.norm(self.com[node] - self.groupCentre[groups[group]], axis=1) - self.groupRadius[groups[group]]
+            inside = (self.start[node] < first + self.groupCount[groups[group]]) & (self.start[node] + self.count[node] > first)
+            accept = ~inside & (distance > 0) & (self.size[node] < theta * distance)
+            leaf = self.isLeaf[node] & ~accept
+            far.append((group[accept], node[accept]))
+            near.append((group[leaf], node[leaf]))
+
+            #Remaining nodes are opened and their children are visited in the next pass
+            opened = ~leaf & ~accept
+            node, pair = _ranges(self.childStart[node[opened]], self.childCount[node[opened]])
+            group = group[opened][pair]
+
+        return [np.concatenate(pairs) for pairs in zip(*far)], [np.concatenate(pairs) for pairs in zip(*near)]
+
+    def numInteractions(self, theta):
+        """ Returns the number of (body, source) interactions evaluated for every body with the given opening angle: centers of mass plus bodies of the near leaves"""
+        groups = np.arange(len(self.groupStart))
+        chunkOf = (np.cumsum(self.groupCount) - 1) // BODIES_PER_CHUNK
+        total = 0
+        for chunk in np.split(groups, np.flatnonzero(np.diff(chunkOf)) + 1):
+            (farGroup, _), (nearGroup, nearLeaf) = self.interactionLists(chunk, theta)
+            total += np.sum(self.groupCount[chunk[farGroup]]) + np.sum(self.groupCount[chunk[nearGroup]] * self.count[nearLeaf])
+        return int(total)
+
+    def chunkAccelerations(self, groups, G, softening, theta, potential = False):
+        """
+        Calculates the accelerations of the bodies of a chunk of groups, and returns them with the indexes of the bodies in the sorted order,
+        and G * the sum of m/r over the sources of each body when potential is True (None otherwise)
+        """
+        chunkBodies, _ = _ranges(self.groupStart[groups], self.groupCount[groups])
+        (farGroup, farNode), (nearGroup, nearLeaf) = self.interactionLists(groups, theta)
+
+        #Sources of each group: the centers of mass of its far nodes and the bodies of its near leaves (including its own bodies, whose self interaction is removed below)
+        nearBodies, pair = _ranges(self.start[nearLeaf], self.count[nearLeaf])
+        sourceGroup = np.concatenate([farGroup, nearGroup[pair]])
+        order = np.argsort(sourceGroup, kind='stable')
+        sourcePositions = np.concatenate([self.com[farNode], self.positions[nearBodies]])[order]
+        sourceMasses = np.concatenate([self.mass[farNode], self.masses[nearBodies]])[order].astype(self.dtype)
+        sourceBodies = np.concatenate([np.full(len(farNode), -1), nearBodies])[order]
+        numSources = np.bincount(sourceGroup, minlength=len(groups))
+        firstSource = np.cumsum(numSources) - numSources
+
+        #Column of each body in the list of its own group, where its self interaction is
+        sourceGroup = sourceGroup[order]
+        own = np.flatnonzero((sourceBodies >= 0) & (self.groupOf[sourceBodies] == groups[sourceGroup]))
+        selfColumn = np.empty(len(chunkBodies), dtype=int)
+        selfColumn[np.searchsorted(chunkBodies, sourceBodies[own])] = own - firstSource[sourceGroup[own]]
+
+        #Groups with similar numbers of bodies and of sources are evaluated together, each one against its own padded list of sources: they are sorted
+        #by the power of two above their number of bodies (the largest number of rows of a batch) and then by their number of sources
+        eps2 = softening**2
+        accChunk = np.zeros((len(chunkBodies), 3), self.dtype)
+        phiChunk = np.zeros(len(chunkBodies)) if potential else None
+        firstBody = np.cumsum(self.groupCount[groups]) - self.groupCount[groups] #position of the first body of each group in chunkBodies
+        rowBound = 2**np.ceil(np.log2(self.groupCount[groups])).astype(int)
+        groupOrder = np.lexsort((numSources, rowBound))
+        boundEnd = np.searchsorted(rowBound[groupOrder], rowBound[groupOrder], side='right')
+        batchStart = 0
+        while batchStart < len(groupOrder):
+            #largest batch of groups with the same bound whose padded [group, body, source] arrays have at most PAIRS_PER_BATCH elements
+            candidates = groupOrder[batchStart:boundEnd[batchStart]]
+            size = np.arange(1, len(candidates) + 1) * rowBound[candidates] * numSources[candidates]
+            batch = candidates[:max(1, np.searchsorted(size, PAIRS_PER_BATCH, side='right'))]
+            batchStart += len(batch)
+            width = numSources[batch[-1]]
+            if not width:
+                continue
+            height = self.groupCount[groups[batch]].max()
+            rows = np.minimum(np.arange(height), self.groupCount[groups[batch], np.newaxis] - 1) #bodies of the group, the last one repeated to fill the rows
+            columns = np.arange(width)
+            valid = columns < numSources[batch, np.newaxis]
+            sources = firstSource[batch, np.newaxis] + np.where(valid, columns, 0)
+
+            #Coordinates relative to the center of the group, which keeps the expansion of the squared distances below accurate (also in float32)
+            centre = self.groupCentre[groups[batch], np.newaxis, :]
+            bodies = self.groupStart[groups[batch], np.newaxis] + rows
+            x = (self.positions[bodies] - centre).astype(self.dtype)
+            s = (sourcePositions[sources] - centre).astype(self.dtype)
+
+            #|s - x|² = |s|² + |x|² - 2 x·s, and the sum of m (s - x)/r³ = (m/r³)·s - x * sum of m/r³, with matrix products over the sources
+            dist2 = np.einsum('bik,bik->bi', x, x)[:, :, np.newaxis] + np.einsum('bjk,bjk->bj', s, s)[:, np.newaxis, :] - 2 * x @ s.transpose(0, 2, 1)
+            np.maximum(dist2, 0, out=dist2)
+            dist2 += eps2
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weight = np.where(valid, sourceMasses[sources], 0)[:, np.newaxis, :] / (np.sqrt(dist2) * dist2)
+            weight[np.arange(len(batch))[:, np.newaxis], np.arange(height), selfColumn[firstBody[batch, np.newaxis] + rows]] = 0
+            if not eps2:
+                weight[~np.isfinite(weight)] = 0 #bodies at the same position, which the direct sum also cannot handle
+            acc = G * (weight @ s - x * weight.sum(axis=2)[:, :, np.newaxis])
+
+            used = rows == np.arange(height)
+            accChunk[(firstBody[batch, np.newaxis] + rows)[used]] = acc[used]
+            if potential:
+                #m/r = (m/r³) * r², from the same weights (which are zero for the padding and the self interactions)
+                phiChunk[(firstBody[batch, np.newaxis] + rows)[used]] = G * np.einsum('bij,bij->bi', weight, dist2)[used]
+
+        return chunkBodies, accChunk, phiChunk
+
+def barnesHutAccelerations(positions, masses, G, softening = 0, theta = 0.5, leafSize = 8, targets = None, workers = 1, groupSize = GROUP_SIZE, potential = False):
+    """
+    Builds an octree from the given positions and calculates the accelerations of the bodies with the Barnes-Hut approximation.
+
+    Takes the same inputs as forces.directAccelerations, plus:
+        - theta: Opening angle of the approximation
+            numerical value as int or float
+        - leafSize: Maximum number of bodies kept in a leaf of the tree
+            int
+        - workers: Number of threads used to traverse the tree
+            int
+        - potential: Whether the potential energy of the tree approximation is also calculated, from the same interactions
+            bool
+
+    Returns an array of shape [numOfTargets, 3] with the resulting accelerations, evaluated in the floating point type of the positions,
+    or a tuple (accelerations, potential energy) when potential is True.
+    """
+    return Octree(positions, masses, leafSize, groupSize).accelerations(G, softening, theta, targets, workers, potential)
+
+def _randomCluster(numOfBodies, seed = 0):
+    """ Generates a Plummer-like cluster of equal mass bodies, used by the reports below"""
+    rng = np.random.default_rng(seed)
+    radius = (rng.uniform(0, 0.99, numOfBodies)**(-2/3) - 1)**-0.5
+    direction = rng.normal(size=(numOfBodies, 3))
+    direction /= np.linalg.norm(direction, axis=1)[:, np.newaxis]
+    return radius[:, np.newaxis] * direction, np.full(numOfBodies, 1 / numOfBodies)
+
+def accuracyReport(numOfBodies = 5000, thetas = (0.0, 0.2, 0.3, 0.5, 0.7, 1.0), softening = 1e-3):
+    """ Prints the relative error of the Barnes-Hut accelerations against the direct sum for several opening angles"""
+    positions, masses = _randomCluster(numOfBodies)
+    reference = directAccelerations(positions, masses, 1, softening)
+    refNorm = np.linalg.norm(reference, axis=1)
+
+    print(f'Accuracy vs theta (n = {numOfBodies})')
+    print(f'{"theta":>6} {"median":>10} {"99%":>10} {"max":>10} {"time [s]":>10}')
+    for theta in thetas:
+        start = time.perf_counter()
+        acc = barnesHutAccelerations(positions, masses, 1, softening, theta)
+        elapsed = time.perf_counter() - start
+        error = np.linalg.norm(acc - reference, axis=1) / refNorm
+        print(f'{theta:6.2f} {np.median(error):10.2e} {np.percentile(error, 99):10.2e} {error.max():10.2e} {elapsed:10.3f}')
+
+def scalingReport(sizes = (1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000), thetas = (0.5, 0.7, 1.0), maxDirect = 16000):
+    """
+    Prints the time per force evaluation of the Barnes-Hut and direct kernels as the number of bodies grows. For Barnes-Hut it also prints the
+    number of interactions per body (which grows as log n) and the time per interaction, which stays about constant when the time is spent
+    evaluating the interaction lists
+    """
+    print(f'Scaling (thetas = {", ".join(map(str, thetas))})')
+    print(f'{"n":>8} {"theta":>6} {"BH [s]":>10} {"inter./body":>12} {"BH/inter. [ns]":>15} {"BH/(n log n) [ns]":>18} {"direct [s]":>11} {"direct/n² [ns]":>15}')
+    for numOfBodies in sizes:
+        positions, masses = _randomCluster(numOfBodies)
+        for theta in thetas:
+            start = time.perf_counter()
+            barnesHutAccelerations(positions, masses, 1, 1e-3, theta)
+            treeTime = time.perf_counter() - start
+            interactions = Octree(positions, masses).numInteractions(theta)
+            line = (f'{numOfBodies:8d} {theta:6.2f} {treeTime:10.3f} {interactions / numOfBodies:12.0f} {treeTime / interactions * 1e9:15.2f}'
+                    f' {treeTime / (numOfBodies * np.log2(numOfBodies)) * 1e9:18.1f}')
+            if numOfBodies <= maxDirect and theta == thetas[0]:
+                start = time.perf_counter()
+                directAccelerations(positions, masses, 1, 1e-3)
+                directTime = time.perf_counter() - start
+                line += f' {directTime:11.3f} {directTime / numOfBodies**2 * 1e9:15.2f}'
+            print(line)
+
+if __name__ == "__main__":
+    accuracyReport()
+    print()
+    scalingReport()
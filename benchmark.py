@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+from body import BodySet, CreateBodyPen
+from gravitySim import GravitySim
+from pendulumSim import PendulumSim
+from barnesHut import _randomCluster
+
+#Defaults of the command line; the largest cases take about a minute on one core
+BODY_COUNTS = (10, 100, 1000)
+STEP_COUNTS = (100, 1000)
+GRAVITY_METHODS = ('verlet', 'rk4')
+FORCE_METHODS = ('direct', 'barnes_hut')
+PENDULUM_STEPS = (1000, 100000)
+PENDULUM_METHODS = ('euler', 'rk4')
+RENDER_FRAMES = 20
+PRECISIONS = ('double', 'mixed', 'single')
+PRECISION_BODIES = 1000
+PRECISION_STEPS = 100
+DRIFT_STEPS = 20000
+
+#Modules of the numerical core, which are imported by the sweep workers and must not import the plotting and export layers
+CORE_MODULES = ('body', 'integrators', 'forces', 'barnesHut', 'collisions', 'storage', 'gravitySim', 'pendulumSim', 'sweep')
+
+#Dependencies that take long to import; only the plotting and export functions (and the compiled pendulum loops, for numba) may import them
+HEAVY_MODULES = ('matplotlib', 'pandas', 'tqdm', 'pyarrow', 'numba')
+
+#Fields that identify a case, used to match the results of two runs
+CASE_KEYS = ('simulator', 'method', 'force_method', 'precision', 'compensated', 'backend', 'bodies', 'steps')
+
+def gravityScene(numOfBodies, force_method = 'direct', seed = 0, precision = 'double', compensated = False):
+    """ Plummer-like cluster of equal mass bodies at rest (G = 1), the same for every run with the same seed"""
+    positions, masses = _randomCluster(numOfBodies, seed)
+    return GravitySim(BodySet(masses, positions), G=1, softening=1e-2, force_method=force_method, precision=precision, compensated=compensated)
+
+def keplerScene(precision = 'double', compensated = False):
+    """ Slightly eccentric orbit of a light body around a heavy one (G = 1, period close to 2π)"""
+    return GravitySim(BodySet([1, 1e-3], [[0, 0, 0], [1, 0, 0]], [[0, 0, 0], [0, 1.05, 0]]), G=1, precision=precision, compensated=compensated)
+
+def pendulumScene():
+    return PendulumSim(CreateBodyPen(1, 0, 1, 120, label='body1'), CreateBodyPen(1, 0, 1, -10, label='body2'))
+
+def measure(run, memory = True):
+    """
+    Runs the case once to time it, and, when memory is True, a second time under tracemalloc to find its peak memory (tracing slows it down, so it is not timed).
+    run must build its own scene and return it.
+    """
+    start = time.perf_counter()
+    scene = run()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return scene, seconds, peak
+
+def gravityCase(numOfBodies, steps, method, force_method, dt = 1e-3, memory = True):
+    """ Times simulate and export of one GravitySim case"""
+    def run():
+        scene = gravityScene(numOfBodies, force_method)
+        scene.enable_timing()
+        scene.simulate([0, steps * dt], dt=dt, method=method, progress=False)
+        with tempfile.TemporaryDirectory() as directory:
+            scene.export(os.path.join(directory, 'run.npz'), quantities=('positions', 'velocities'))
+        return scene
+
+    scene, seconds, peak = measure(run, memory)
+    phases = scene.timer.report()
+    simulated = seconds - phases.get('export', {}).get('seconds', 0)
+    return {'simulator': 'GravitySim', 'method': method, 'force_method': force_method, 'bodies': numOfBodies, 'steps': steps,
+            'seconds': seconds, 'steps_per_second': steps / simulated, 'peak_memory_bytes': peak, 'phases': phases}
+
+def pendulumCase(steps, method, backend, dt = 1e-3, memory = True):
+    """ Times simulate and export of one PendulumSim case"""
+    #the first run of the Numba backend compiles the loop
+    pendulumScene().simulate([0, 10 * dt], dt=dt, method=method, backend=backend)
+
+    def run():
+        scene = pendulumScene()
+        scene.enable_timing()
+        scene.simulate([0, steps * dt], dt=dt, method=method, backend=backend)
+        with tempfile.TemporaryDirectory() as directory:
+            scene.export(os.path.join(directory, 'run.npz'))
+        return scene
+
+    scene, seconds, peak = measure(run, memory)
+    phases = scene.timer.report()
+    simulated = seconds - phases.get('export', {}).get('seconds', 0)
+    return {'simulator': 'PendulumSim', 'method': method, 'backend': backend, 'bodies': 2, 'steps': steps,
+            'seconds': seconds, 'steps_per_second': steps / simulated, 'peak_memory_bytes': peak, 'phases': phases}
+
+def precisionCase(numOfBodies, steps, precision, compensated, method = 'verlet', dt = 1e-3, memory = True):
+    """ Times the direct forces of a cluster with one precision policy; the peak memory includes the stored samples"""
+    def run():
+        scene = gravityScene(numOfBodies, precision=precision, compensated=compensated)
+        scene.enable_timing()
+        scene.simulate([0, steps * dt], dt=dt, method=method, progress=False)
+        return scene
+
+    scene, seconds, peak = measure(run, memory)
+    return {'simulator': 'GravitySim', 'method': method, 'force_method': 'direct', 'precision': precision, 'compensated': compensated,
+            'bodies': numOfBodies, 'steps': steps, 'seconds': seconds, 'steps_per_second': steps / seconds, 'peak_memory_bytes': peak,
+            'phases': scene.timer.report()}
+
+def keplerRun(steps, precision, compensated, method = 'verlet', dt = 1e-3):
+    """ Simulates the Kepler orbit, recording the energy 100 times; returns the scene, its final positions and the time taken"""
+    scene = keplerScene(precision, compensated)
+    every = max(1, steps // 100)
+    start = time.perf_counter()
+    scene.simulate([0, steps * dt], dt=dt, method=method, save_every=every, progress=False, diagnostics_every=every)
+    seconds = time.perf_counter() - start
+    return scene, scene.ringPositions[scene.step()].astype(np.longdouble), seconds
+
+def driftCase(steps, precision, compensated, method = 'verlet', dt = 1e-3, reference = None):
+    """
+    Rounding error of a long Kepler orbit with one precision policy: the largest distance between its final positions and the reference, the final positions
+    of the same run (same method and dt, hence the same truncation error) with the "extended" policy, calculated when not given.
+    The energy drift is also reported, but with this dt it is dominated by the truncation error of the method, so it hides the rounding errors of float64 runs.
+    """
+    if reference is None:
+        reference = keplerRun(steps, 'extended', False, method, dt)[1]
+    scene, positions, seconds = keplerRun(steps, precision, compensated, method, dt)
+    drift = np.abs(scene.diagnostics.drift())
+    return {'simulator': 'drift', 'method': method, 'precision': precision, 'compensated': compensated, 'bodies': 2, 'steps': steps,
+            'seconds': seconds, 'steps_per_second': steps / seconds, 'position_error': float(np.max(np.abs(positions - reference))),
+            'final_drift': float(drift[-1]), 'max_drift': float(drift.max())}
+
+def renderCase(numOfBodies, frames, resolution = (640, 360), trail_length = 0.05, dt = 1e-3):
+    """ Times the headless rendering of frames of a GravitySim run (display.renderFrames), without writing them"""
+    from display import renderFrames
+
+    scene = gravityScene(numOfBodies)
+    scene.simulate([0, frames * dt], dt=dt, progress=False)
+    timer = scene.enable_timing()
+    start = time.perf_counter()
+    for _ in renderFrames(scene, range(frames), resolution=resolution, trail_length=trail_length):
+        pass
+    seconds = time.perf_counter() - start
+    return {'simulator': 'display', 'method': 'renderFrames', 'bodies': numOfBodies, 'steps': frames,
+            'seconds': seconds, 'frames_per_second': frames / timer.report()['render_frame']['seconds'], 'phases': timer.report()}
+
+def importCase(module, repeats = 3):
+    """ Times the import of a module in new interpreters (the best of repeats runs), and lists the heavy dependencies that it imported"""
+    code = (f'import sys, time, json; start = time.perf_counter(); import {module}; seconds = time.perf_counter() - start; '
+            f'print(json.dumps([seconds, [name for name in {HEAVY_MODULES!r} if name in sys.modules]]))')
+    runs = [json.loads(subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout)
+            for _ in range(repeats)]
+    return {'simulator': 'import', 'method': module, 'seconds': min(seconds for seconds, _ in runs), 'heavy_modules': runs[0][1]}
+
+def metadata():
+    """ Where the results come from: commit of the repository, versions and machine"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        import numba
+        numbaVersion = numba.__version__
+    except ImportError:
+        numbaVersion = None
+    return {'commit': commit, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'numpy': np.__version__,
+            'numba': numbaVersion, 'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count()}
+
+def runBenchmarks(bodies = BODY_COUNTS, steps = STEP_COUNTS, methods = GRAVITY_METHODS, force_methods = FORCE_METHODS,
+                  pendulum_steps = PENDULUM_STEPS, pendulum_methods = PENDULUM_METHODS, backends = ('auto',), frames = RENDER_FRAMES, memory = True,
+                  imports = CORE_MODULES, precisions = PRECISIONS, precision_bodies = PRECISION_BODIES, drift_steps = DRIFT_STEPS, log = sys.stderr):
+    """
+    Runs every combination of the given parameters and returns {'metadata': ..., 'results': [...]}.
+    Each result has the time of the case, the steps per second of the simulation (the export is not counted), the peak memory and the time of each phase of the PhaseTimer.
+    The import time of each of the given modules is measured first. For each precision policy, with and without compensated sums, a cluster of precision_bodies bodies
+    is timed, and the rounding error and energy drift of a Kepler orbit of drift_steps steps are measured (0 skips them).
+    """
+    results = []
+    for module in imports:
+        result = importCase(module)
+        results.append(result)
+        if log is not None:
+            print(f'{describe(result):>50} {result["seconds"]:9.3f} s  {", ".join(result["heavy_modules"]) or "no heavy modules"}', file=log)
+
+    cases = [(gravityCase, (numOfBodies, numOfSteps, method, force_method)) for numOfBodies in bodies for numOfSteps in steps
+             for method in methods for force_method in force_methods]
+    cases += [(pendulumCase, (numOfSteps, method, backend)) for numOfSteps in pendulum_steps for method in pendulum_methods for backend in backends]
+    if precision_bodies:
+        cases += [(precisionCase, (precision_bodies, PRECISION_STEPS, precision, compensated)) for precision in precisions for compensated in (False, True)]
+
+    for function, args in cases:
+        result = function(*args, memory=memory)
+        results.append(result)
+        if log is not None:
+            print(f'{describe(result):>50} {result["seconds"]:9.3f} s {result["steps_per_second"]:12.1f} steps/s', file=log)
+    if drift_steps and precisions:
+        reference = keplerRun(drift_steps, 'extended', False)[1]
+        for precision in precisions:
+            for compensated in (False, True):
+                result = driftCase(drift_steps, precision, compensated, reference=reference)
+                results.append(result)
+                if log is not None:
+                    print(f'{describe(result):>50} {result["seconds"]:9.3f} s {result["position_error"]:12.2e} position error {result["final_drift"]:12.2e} energy drift', file=log)
+    if frames:
+        for numOfBodies in bodies:
+            result = renderCase(numOfBodies, frames)
+            results.append(result)
+            if log is not None:
+                print(f'{describe(result):>50} {result["seconds"]:9.3f} s {result["frames_per_second"]:12.1f} frames/s', file=log)
+    return {'metadata': metadata(), 'results': results}
+
+def describe(result):
+    return ' '.join(f'{key}={result[key]}' for key in CASE_KEYS if key in result)
+
+def compareResults(old, new):
+    """ Prints, for the cases present in both runs, the ratio between the new and the old throughput (above 1 means faster)"""
+    def key(result):
+        return tuple(result.get(name) for name in CASE_KEYS)
+
+    def rate(result):
+        return result.get('steps_per_second', result.get('frames_per_second', 1 / result['seconds']))
+
+    previous = {key(result): result for result in old['results']}
+    print(f'Compared with commit {old["metadata"].get("commit")}')
+    print(f'{"case":>50} {"old":>12} {"new":>12} {"speedup":>8}')
+    for result in new['results']:
+        if key(result) in previous:
+            before, after = rate(previous[key(result)]), rate(result)
+            print(f'{describe(result):>50} {before:12.1f} {after:12.1f} {after / before:8.2f}')
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Measures the throughput, peak memory and time of each phase of the simulations, and writes them as JSON.')
+    parser.add_argument('--bodies', type=int, nargs='+', default=BODY_COUNTS, help='numbers of bodies of the GravitySim cases')
+    parser.add_argument('--steps', type=int, nargs='+', default=STEP_COUNTS, help='numbers of steps of the GravitySim cases')
+    parser.add_argument('--methods', nargs='+', default=GRAVITY_METHODS, help='integration methods of the GravitySim cases')
+    parser.add_argument('--force-methods', nargs='+', default=FORCE_METHODS, help='force methods of the GravitySim cases')
+    parser.add_argument('--pendulum-steps', type=int, nargs='*', default=PENDULUM_STEPS, help='numbers of steps of the PendulumSim cases (none to skip them)')
+    parser.add_argument('--pendulum-methods', nargs='+', default=PENDULUM_METHODS, help='integration methods of the PendulumSim cases')
+    parser.add_argument('--backends', nargs='+', default=('auto',), help='backends of the PendulumSim cases ("auto", "numba" or "numpy")')
+    parser.add_argument('--frames', type=int, default=RENDER_FRAMES, help='number of frames rendered for each number of bodies (0 to skip the rendering)')
+    parser.add_argument('--precisions', nargs='*', default=PRECISIONS, help='precision policies compared, each with and without compensated sums (none to skip them)')
+    parser.add_argument('--precision-bodies', type=int, default=PRECISION_BODIES, help='number of bodies of the precision cases (0 to skip them)')
+    parser.add_argument('--drift-steps', type=int, default=DRIFT_STEPS, help='number of steps of the Kepler orbit whose rounding error and energy drift are measured (0 to skip it)')
+    parser.add_argument('--no-memory', action='store_true', help='skip the second run of each case that measures the peak memory')
+    parser.add_argument('--imports', nargs='*', default=CORE_MODULES, help='modules whose import time is measured (none to skip them)')
+    parser.add_argument('--imports-only', action='store_true', help='only measure the import times')
+    parser.add_argument('--check-imports', action='store_true',
+                        help=f'exit with an error when a core module imports one of {", ".join(HEAVY_MODULES)} (numba is accepted)')
+    parser.add_argument('--output', help='JSON file where the results are written (printed when not given)')
+    parser.add_argument('--compare', help='JSON file of a previous run, whose throughput is compared with this one')
+    args = parser.parse_args(argv)
+
+    if args.imports_only:
+        report = runBenchmarks((), (), (), (), (), (), (), 0, imports=args.imports, precisions=())
+    else:
+        report = runBenchmarks(args.bodies, args.steps, args.methods, args.force_methods, args.pendulum_steps, args.pendulum_methods,
+                               args.backends, args.frames, not args.no_memory, args.imports, args.precisions, args.precision_bodies, args.drift_steps)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as file:
+            compareResults(json.load(file), report)
+    if args.check_imports:
+        heavy = {result['method']: [name for name in result['heavy_modules'] if name != 'numba'] for result in report['results'] if result['simulator'] == 'import'}
+        heavy = {module: names for module, names in heavy.items() if names}
+        if heavy:
+            sys.exit('Heavy modules imported by the core: ' + '; '.join(f'{module}: {", ".join(names)}' for module, names in heavy.items()))
+
+if __name__ == "__main__":
+    main()
@@ -66,6 +66,141 @@ class CreateBodyPen:
     #    return f'\nBody type object\n\tmass = {self.mass}\n\tposition = {self.position}\n\tvelocity = {self.velocity}\n\tacceleration = {self.acceleration}\n\tsize = {self.size}\n'
 
 
+class BodySet:
+    """
+    Set of bodies of a gravitational simulation stored as contiguous arrays (one array per property instead of one object per body),
+    so large initial conditions are created with vectorized operations and used by GravitySim without copying each body.
+
+    Takes the following variables as initialization values:
+        - masses: Mass of each body
+            array of shape [numOfBodies]
+        - positions: Initial position of each body
+            array of shape [numOfBodies, 3]
+        - velocities: Initial velocity of each body; zero when not provided
+            array of shape [numOfBodies, 3]
+        - sizes: Size of each body, or one size for all of them
+            float or array of shape [numOfBodies]
+        - labels: Name of each body in the legend, or one name for all of them; with labelIndex, the table of the distinct names
+            str or list of str
+        - labelIndex: Position of the name of each body in labels
+            array of int
+
+    The distinct labels are kept once in labelNames, and each body has the index of its label in labelIndex.
+    Indexing with an int returns the body as a CreateBodyGrav object, and indexing with a slice or an array of indexes returns a smaller BodySet.
+    """
+
+    def __init__(self, masses, positions, velocities = None, sizes = 1, labels = 'body', labelIndex = None):
+        self.positions = np.array(positions, dtype=float).reshape(-1, 3)
+        numOfBodies = len(self.positions)
+        self.velocities = np.zeros((numOfBodies, 3)) if velocities is None else np.array(velocities, dtype=float).reshape(numOfBodies, 3)
+        self.masses = np.array(np.broadcast_to(np.asarray(masses, dtype=float), numOfBodies))
+        self.sizes = np.array(np.broadcast_to(np.asarray(sizes, dtype=float), numOfBodies))
+
+        if labelIndex is not None:
+            self.labelNames = np.asarray(labels, dtype=str)
+            self.labelIndex = np.asarray(labelIndex, dtype=np.int32)
+        elif isinstance(labels, str):
+            self.labelNames = np.array([labels])
+            self.labelIndex = np.zeros(numOfBodies, dtype=np.int32)
+        else:
+            self.labelNames, labelIndex = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+            self.labelIndex = labelIndex.astype(np.int32)
+
+    @classmethod
+    def fromBodies(cls, bodies):
+        """ Creates a set with the properties of a list of CreateBodyGrav objects"""
+        return cls([body.mass for body in bodies], [body.position for body in bodies], [body.velocity for body in bodies],
+                   [body.size for body in bodies], [body.label for body in bodies])
+
+    @classmethod
+    def concatenate(cls, sets):
+        """ Joins several sets into one, in the given order"""
+        return cls(np.concatenate([bodies.masses for bodies in sets]), np.concatenate([bodies.positions for bodies in sets]),
+                   np.concatenate([bodies.velocities for bodies in sets]), np.concatenate([bodies.sizes for bodies in sets]),
+                   np.concatenate([bodies.labels for bodies in sets]))
+
+    @classmethod
+    def plummer(cls, numOfBodies, totalMass = 1, scaleRadius = 1, G = 1, size = 1, label = 'body', seed = 0, maxFraction = 0.999):
+        """
+        Equal mass bodies sampled from a Plummer sphere in equilibrium (Aarseth, Hénon & Wielen, 1974), moved to the frame of their centre of mass.
+        The radii are sampled from the cumulative mass profile, up to maxFraction of the total mass, and the speeds from the distribution function, by rejection.
+        """
+        rng = np.random.default_rng(seed)
+        radii = scaleRadius / np.sqrt(rng.uniform(0, maxFraction, numOfBodies)**(-2/3) - 1)
+
+        #fraction q of the escape speed, with probability proportional to q²(1 - q²)^(7/2), whose maximum is below 0.1
+        fractions = np.empty(numOfBodies)
+        missing = np.arange(numOfBodies)
+        while len(missing):
+            q, y = rng.uniform(0, 1, len(missing)), rng.uniform(0, 0.1, len(missing))
+            accepted = y < q**2 * (1 - q**2)**3.5
+            fractions[missing[accepted]] = q[accepted]
+            missing = missing[~accepted]
+        speeds = fractions * np.sqrt(2 * G * totalMass) * (radii**2 + scaleRadius**2)**-0.25
+
+        positions = radii[:, np.newaxis] * randomDirections(rng, numOfBodies)
+        velocities = speeds[:, np.newaxis] * randomDirections(rng, numOfBodies)
+        positions -= positions.mean(axis=0)
+        velocities -= velocities.mean(axis=0)
+        return cls(totalMass / numOfBodies, positions, velocities, size, label)
+
+    @classmethod
+    def uniformDisk(cls, numOfBodies, radius = 1, totalMass = 1, centralMass = 0, G = 1, thickness = 0, size = 1, label = 'body', centralLabel = 'centre', seed = 0):
+        """
+        Equal mass bodies spread uniformly over a disk in the xy plane, in circular orbits around its centre, with the speed given by the mass inside their radius
+        (the central mass plus the disk mass inside it, as if it were spherical). The heights follow a normal distribution of standard deviation thickness.
+        When centralMass is not zero, a body with that mass is added at the centre, as the first body of the set.
+        """
+        rng = np.random.default_rng(seed)
+        radii = radius * np.sqrt(rng.uniform(0, 1, numOfBodies))
+        angles = rng.uniform(0, 2 * np.pi, numOfBodies)
+        positions = np.stack([radii * np.cos(angles), radii * np.sin(angles), thickness * rng.normal(size=numOfBodies)], axis=1)
+        speeds = np.sqrt(G * (centralMass + totalMass * (radii / radius)**2) / np.maximum(radii, 1e-12 * radius))
+        velocities = np.stack([-speeds * np.sin(angles), speeds * np.cos(angles), np.zeros(numOfBodies)], axis=1)
+        disk = cls(totalMass / numOfBodies, positions, velocities, size, label)
+        if not centralMass:
+            return disk
+        return cls.concatenate([cls(centralMass, [0, 0, 0], sizes=size, labels=centralLabel), disk])
+
+    @classmethod
+    def keplerRings(cls, centralMass, ringRadii, bodiesPerRing, bodyMass = 0, G = 1, size = 1, label = 'body', centralLabel = 'centre', seed = 0):
+        """
+        A central body at the origin and rings of bodies in circular Keplerian orbits around it (speed sqrt(G*centralMass/r)) in the xy plane.
+        The bodies of each ring are evenly spaced, starting from a random angle. bodiesPerRing is one number for all rings or one number per ring.
+        """
+        rng = np.random.default_rng(seed)
+        ringRadii = np.asarray(ringRadii, dtype=float).reshape(-1)
+        counts = np.broadcast_to(bodiesPerRing, ringRadii.shape)
+        radii = np.repeat(ringRadii, counts)
+        starts = np.cumsum(counts) - counts
+        angles = np.repeat(rng.uniform(0, 2 * np.pi, len(ringRadii)), counts) + 2 * np.pi * (np.arange(len(radii)) - np.repeat(starts, counts)) / np.repeat(counts, counts)
+        speeds = np.sqrt(G * centralMass / radii)
+        positions = np.stack([radii * np.cos(angles), radii * np.sin(angles), np.zeros(len(radii))], axis=1)
+        velocities = np.stack([-speeds * np.sin(angles), speeds * np.cos(angles), np.zeros(len(radii))], axis=1)
+        return cls.concatenate([cls(centralMass, [0, 0, 0], sizes=size, labels=centralLabel), cls(bodyMass, positions, velocities, size, label)])
+
+    @property
+    def labels(self):
+        """ Label of each body"""
+        return self.labelNames[self.labelIndex]
+
+    def __len__(self):
+        return len(self.masses)
+
+    def __getitem__(self, index):
+        if np.ndim(index) == 0 and not isinstance(index, slice):
+            return CreateBodyGrav(self.masses[index], self.positions[index], self.velocities[index], size=self.sizes[index], label=str(self.labelNames[self.labelIndex[index]]))
+        return BodySet(self.masses[index], self.positions[index], self.velocities[index], self.sizes[index], self.labelNames, self.labelIndex[index])
+
+    def __str__(self) -> str:
+        return f'\nBodySet object\n\tbodies = {len(self)}\n\ttotal mass = {self.masses.sum()}\n\tlabels = {len(self.labelNames)} distinct\n'
+
+def randomDirections(rng, numOfDirections):
+    """ Unit vectors uniformly distributed over the sphere"""
+    directions = rng.normal(size=(numOfDirections, 3))
+    return directions / np.linalg.norm(directions, axis=1)[:, np.newaxis]
+
+
 if __name__ == "__main__":
 
     corpo1 = CreateBodyPen(1,0, 1, 120, 10)
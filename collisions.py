@@ -0,0 +1,164 @@
+import time
+import numpy as np
+
+#Ways to resolve a collision: "merge" joins the bodies into one (perfectly inelastic, conserves mass and momentum); "bounce" reflects their relative velocity
+MODES = ('merge', 'bounce')
+
+#Neighbouring cells searched for each body: the cell itself and half of the 26 around it, since the pairs of the other half are found from the other body
+NEIGHBOUR_OFFSETS = np.array([(0, 0, 0)] + [(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1) if (i, j, k) > (0, 0, 0)], dtype=np.int64)
+
+#Multipliers of the spatial hash of the cells (Teschner et al., 2003)
+HASH_PRIMES = np.array([73856093, 19349663, 83492791], dtype=np.int64)
+
+def cellKeys(cells):
+    """ Spatial hash of integer cell coordinates; different cells may share a key, which only adds candidate pairs that are then discarded"""
+    keys = cells * HASH_PRIMES
+    return keys[..., 0] ^ keys[..., 1] ^ keys[..., 2]
+
+def overlappingPairs(positions, radii):
+    """
+    Finds the pairs of bodies that overlap (|x_i - x_j| < r_i + r_j) with a uniform grid, instead of testing all pairs.
+    The cells are as large as the largest diameter, so overlapping bodies are always in the same or in neighbouring cells;
+    the occupied cells are hashed and sorted, so the cost is O(n log n) and does not depend on how far apart the bodies are.
+
+    Takes the following variables as input:
+        - positions: Positions of the bodies
+            array of shape [numOfBodies, 3]
+        - radii: Radius of each body
+            array of shape [numOfBodies]
+
+    Returns an array of shape [numOfPairs, 2] with the indexes (i < j) of the overlapping bodies.
+    """
+    numOfBodies = len(positions)
+    cellSize = 2 * np.max(radii) if numOfBodies else 0
+    if numOfBodies < 2 or cellSize <= 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    cells = np.floor(positions / cellSize).astype(np.int64)
+    keys = cellKeys(cells)
+    order = np.argsort(keys, kind='stable')
+    cellKey, cellStart, cellCount = np.unique(keys[order], return_index=True, return_counts=True)
+
+    candidates = []
+    for offset in NEIGHBOUR_OFFSETS:
+        neighbourKeys = cellKeys(cells + offset)
+        cell = np.minimum(np.searchsorted(cellKey, neighbourKeys), len(cellKey) - 1)
+        counts = np.where(cellKey[cell] == neighbourKeys, cellCount[cell], 0)
+        if not counts.any():
+            continue
+        #each body i is paired with every body of the neighbouring cell, which are the counts[i] bodies of order after cellStart[cell[i]]
+        first = np.repeat(np.arange(numOfBodies), counts)
+        within = np.arange(len(first)) - np.repeat(np.cumsum(counts) - counts, counts)
+        second = order[np.repeat(cellStart[cell], counts) + within]
+        keep = first != second
+        first, second = first[keep], second[keep]
+        candidates.append(np.minimum(first, second) * numOfBodies + np.maximum(first, second))
+    if not candidates:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    #a pair appears more than once when two searched cells share a key
+    pairs = np.stack(np.divmod(np.unique(np.concatenate(candidates)), numOfBodies), axis=1)
+    separation = positions[pairs[:, 0]] - positions[pairs[:, 1]]
+    reach = radii[pairs[:, 0]] + radii[pairs[:, 1]]
+    return pairs[np.einsum('ij,ij->i', separation, separation) < reach**2]
+
+def connectedGroups(numOfBodies, pairs):
+    """ Label of the group of each body, where bodies joined by a chain of pairs share the label of the lowest index among them"""
+    labels = np.arange(numOfBodies)
+    while True:
+        lowest = np.minimum(labels[pairs[:, 0]], labels[pairs[:, 1]])
+        updated = labels.copy()
+        np.minimum.at(updated, pairs[:, 0], lowest)
+        np.minimum.at(updated, pairs[:, 1], lowest)
+        updated = updated[updated] #pointer jumping: each label takes the label of its own label
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+def mergeBodies(positions, velocities, masses, radii, pairs):
+    """
+    Joins each group of overlapping bodies into its most massive body, which takes the total mass, the position of the centre of mass,
+    the velocity that conserves the momentum and the radius that conserves the volume. The other bodies of the group are removed.
+
+    Returns the indexes of the bodies that remain, the merges as an array of shape [numOfMerges, 2] (survivor, absorbed body),
+    and the new positions, velocities, masses and radii of the remaining bodies.
+    """
+    numOfBodies = len(masses)
+    groups = connectedGroups(numOfBodies, pairs)
+    colliding = np.zeros(numOfBodies, dtype=bool)
+    colliding[pairs.ravel()] = True
+
+    #survivor of each group: its most massive body, the first one in case of ties
+    order = np.lexsort((np.arange(numOfBodies), -masses, groups))
+    isFirst = np.ones(numOfBodies, dtype=bool)
+    isFirst[1:] = groups[order[1:]] != groups[order[:-1]]
+    survivorOf = np.empty(numOfBodies, dtype=np.int64)
+    survivorOf[groups[order[isFirst]]] = order[isFirst]
+    survivors = survivorOf[groups]
+
+    totalMass = np.bincount(groups, masses, numOfBodies)
+    weighted = lambda values: np.stack([np.bincount(groups, masses * values[:, k], numOfBodies) for k in range(3)], axis=1) / np.where(totalMass > 0, totalMass, 1)[:, np.newaxis]
+    positions, velocities = positions.copy(), velocities.copy()
+    positions[colliding] = weighted(positions)[groups[colliding]]
+    velocities[colliding] = weighted(velocities)[groups[colliding]]
+    masses = totalMass[groups]
+    radii = np.cbrt(np.bincount(groups, radii**3, numOfBodies))[groups]
+
+    remaining = np.flatnonzero(survivors == np.arange(numOfBodies))
+    absorbed = np.flatnonzero(survivors != np.arange(numOfBodies))
+    merges = np.stack([survivors[absorbed], absorbed], axis=1)
+    return remaining, merges, positions[remaining], velocities[remaining], masses[remaining], radii[remaining]
+
+def bounceBodies(positions, velocities, masses, pairs, restitution = 1.0):
+    """
+    Reflects the component of the relative velocity along the line between the centres of the pairs that are approaching each other,
+    scaled by the coefficient of restitution (1 is an elastic bounce, which conserves the kinetic energy). Every impulse conserves the momentum.
+    The impulses of a body that touches several others are calculated from the velocities before the collisions and added.
+    Bodies at the same position have no line between their centres; they bounce along their relative velocity (a head-on collision),
+    and are left as they are when they also have the same velocity.
+
+    Returns the new velocities and the pairs that bounced.
+    """
+    relative = velocities[pairs[:, 0]] - velocities[pairs[:, 1]]
+    normal = positions[pairs[:, 0]] - positions[pairs[:, 1]]
+    coincident = ~np.any(normal, axis=1)
+    normal[coincident] = -relative[coincident]
+    length = np.linalg.norm(normal, axis=1)
+    normal /= np.where(length > 0, length, 1)[:, np.newaxis]
+    approach = np.einsum('ij,ij->i', relative, normal)
+    approaching = approach < 0
+    pairs, normal, approach = pairs[approaching], normal[approaching], approach[approaching]
+
+    first, second = masses[pairs[:, 0]], masses[pairs[:, 1]]
+    impulse = (-(1 + restitution) * first * second / (first + second) * approach)[:, np.newaxis] * normal
+    velocities = velocities.copy()
+    np.add.at(velocities, pairs[:, 0], impulse / first[:, np.newaxis])
+    np.add.at(velocities, pairs[:, 1], -impulse / second[:, np.newaxis])
+    return velocities, pairs
+
+def bruteForcePairs(positions, radii):
+    """ Overlapping pairs found by testing all pairs, O(n²); used to check overlappingPairs"""
+    separation = np.linalg.norm(positions[:, np.newaxis] - positions[np.newaxis], axis=2)
+    first, second = np.nonzero(np.triu(separation < radii[:, np.newaxis] + radii[np.newaxis], 1))
+    return np.stack([first, second], axis=1)
+
+def scalingReport(sizes = (1000, 4000, 16000, 64000, 256000), radius = 0.002, maxBruteForce = 8000):
+    """ Prints the time to find the overlapping pairs of a uniform cloud of bodies with the grid and by testing all pairs, as the number of bodies grows"""
+    print(f'Collision search (radius = {radius})')
+    print(f'{"n":>8} {"pairs":>8} {"grid [s]":>10} {"grid/n [ns]":>12} {"all pairs [s]":>14}')
+    rng = np.random.default_rng(0)
+    for numOfBodies in sizes:
+        positions = rng.uniform(-1, 1, size=(numOfBodies, 3))
+        radii = np.full(numOfBodies, radius)
+        start = time.perf_counter()
+        pairs = overlappingPairs(positions, radii)
+        gridTime = time.perf_counter() - start
+        line = f'{numOfBodies:8d} {len(pairs):8d} {gridTime:10.3f} {gridTime / numOfBodies * 1e9:12.1f}'
+        if numOfBodies <= maxBruteForce:
+            start = time.perf_counter()
+            assert np.array_equal(bruteForcePairs(positions, radii), pairs)
+            line += f' {time.perf_counter() - start:14.3f}'
+        print(line)
+
+if __name__ == "__main__":
+    scalingReport()
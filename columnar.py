@@ -0,0 +1,154 @@
+import os
+import json
+import importlib.util
+import numpy as np
+
+#pyarrow is optional: it is only needed to write Parquet files, so it is imported only then
+HAS_ARROW = importlib.util.find_spec('pyarrow') is not None
+
+FORMATS = ('parquet', 'npz', 'npy')
+
+#"long": one row per sample and body, with one column per quantity and coordinate; "tensor": one [sample, body, coordinate] array per quantity
+LAYOUTS = ('long', 'tensor')
+
+#Number of samples read from the simulation at once; in Parquet files each chunk is written as one row group
+CHUNK_SAMPLES = 4096
+
+def inferFormat(path):
+    """ Format given by the extension of the path: ".parquet", ".npz", or a folder of .npy files for any other path"""
+    return {'.parquet': 'parquet', '.npz': 'npz'}.get(os.path.splitext(path)[1].lower(), 'npy')
+
+def sampleChunks(numSamples, stride, chunkSamples = CHUNK_SAMPLES):
+    """ Slices that select, in chunks of chunkSamples, one of every stride samples"""
+    step = chunkSamples * stride
+    for start in range(0, numSamples, step):
+        yield slice(start, min(start + step, numSamples), stride)
+
+def longColumns(time, arrays, coordinates, samples):
+    """
+    Columns of the long layout for the selected samples: time, body and one column per quantity and coordinate (e.g. "positions_x").
+    The number of columns does not depend on the number of bodies, and each one is filled by a single vectorized copy.
+    """
+    block = {quantity: np.asarray(array[samples]) for quantity, array in arrays.items()}
+    numRows, numOfBodies = next(iter(block.values())).shape[:2]
+    columns = {'time': np.repeat(time[samples], numOfBodies), 'body': np.tile(np.arange(numOfBodies), numRows)}
+    for quantity, values in block.items():
+        for index, coordinate in enumerate(coordinates):
+            columns[f'{quantity}_{coordinate}'] = values[:, :, index].ravel()
+    return columns
+
+def tensorColumns(time, arrays, samples):
+    """ Arrays of the tensor layout for the selected samples: time and one [sample, body, coordinate] array per quantity"""
+    columns = {'time': time[samples]}
+    columns.update({quantity: np.asarray(array[samples]) for quantity, array in arrays.items()})
+    return columns
+
+def exportTrajectories(path, time, arrays, coordinates = ('x', 'y', 'z'), labelNames = None, labelIndex = None, layout = 'long', format = None, stride = 1,
+                       chunkSamples = CHUNK_SAMPLES):
+    """
+    Writes stored samples of a simulation straight from its arrays, reading them in chunks (they may be memory-mapped).
+
+    Takes the following variables as input:
+        - path: File (".parquet" or ".npz") or folder (one .npy file per column or quantity) that will be written
+            str
+        - time: Time of each stored sample
+            array of floats
+        - arrays: Quantities that will be exported, as time-major arrays
+            dict of {name: [sample, body, coordinate] array}
+        - coordinates: Names of the coordinates, used in the columns of the long layout
+            tuple of str
+        - labelNames: Distinct labels of the bodies, saved once (as the dictionary of the label column in Parquet files)
+            array of str
+        - labelIndex: Position of the label of each body in labelNames
+            array of int
+        - layout: "long" (one row per sample and body) or "tensor" (one [sample, body, coordinate] array per quantity)
+            str
+        - format: "parquet" (needs pyarrow), "npz" or "npy"; when not provided, it is given by the extension of the path
+            str
+        - stride: Only one of every stride samples is exported
+            int
+        - chunkSamples: Number of samples read at once, which is also the number of samples of each Parquet row group
+            int
+
+    """
+    format = inferFormat(path) if format is None else format
+    if format not in FORMATS:
+        raise ValueError(f'Unknown format "{format}", use one of: {", ".join(FORMATS)}')
+    if layout not in LAYOUTS:
+        raise ValueError(f'Unknown layout "{layout}", use one of: {", ".join(LAYOUTS)}')
+
+    time = np.asarray(time)
+    numOfBodies = next(iter(arrays.values())).shape[1]
+    numRows = len(range(0, len(time), stride))
+    if layout == 'long':
+        chunks = (longColumns(time, arrays, coordinates, samples) for samples in sampleChunks(len(time), stride, chunkSamples))
+        spec = {'time': ((numRows * numOfBodies,), time.dtype), 'body': ((numRows * numOfBodies,), np.int64)}
+        spec.update({f'{quantity}_{coordinate}': ((numRows * numOfBodies,), array.dtype) for quantity, array in arrays.items() for coordinate in coordinates})
+    else:
+        chunks = (tensorColumns(time, arrays, samples) for samples in sampleChunks(len(time), stride, chunkSamples))
+        spec = {'time': ((numRows,), time.dtype)}
+        spec.update({quantity: ((numRows,) + array.shape[1:], array.dtype) for quantity, array in arrays.items()})
+
+    if format == 'parquet':
+        writeParquet(path, chunks, labelNames, labelIndex, {'layout': layout, 'coordinates': list(coordinates), 'numOfBodies': numOfBodies})
+        return
+
+    #npz and npy: the columns are filled chunk by chunk (in memory-mapped files for npy)
+    if format == 'npy':
+        os.makedirs(path, exist_ok=True)
+        outputs = {name: np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape) for name, (shape, dtype) in spec.items()}
+    else:
+        outputs = {name: np.empty(shape, dtype) for name, (shape, dtype) in spec.items()}
+    row = 0
+    for columns in chunks:
+        length = len(columns['time'])
+        for name, values in columns.items():
+            outputs[name][row:row + length] = values
+        row += length
+
+    extras = {'coordinates': np.array(coordinates)}
+    if labelNames is not None:
+        extras['labelNames'] = np.asarray(labelNames, dtype=str)
+        extras['labelIndex'] = np.asarray(labelIndex, dtype=np.int32)
+    if format == 'npy':
+        for output in outputs.values():
+            output.flush()
+        for name, values in extras.items():
+            np.save(os.path.join(path, f'{name}.npy'), values)
+    else:
+        np.savez(path, **outputs, **extras)
+
+def writeParquet(path, chunks, labelNames, labelIndex, metadata):
+    """
+    Writes each chunk of columns as one row group of a Parquet file; the [sample, body, coordinate] arrays of the tensor layout become fixed size list columns.
+    The label of each row is a dictionary column whose dictionary holds the distinct labels only, which are also the only labels in the metadata.
+    """
+    if not HAS_ARROW:
+        raise ImportError('pyarrow is needed to export to Parquet files; use the "npz" or "npy" formats instead')
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if labelNames is not None:
+        metadata = dict(metadata, labelNames=[str(name) for name in labelNames])
+        dictionary = pa.array(metadata['labelNames'])
+        labelIndex = np.asarray(labelIndex, dtype=np.int32)
+
+    writer = None
+    try:
+        for columns in chunks:
+            fields = {}
+            for name, values in columns.items():
+                if values.ndim > 1:
+                    #the flat values are wrapped without a copy
+                    fields[name] = pa.FixedSizeListArray.from_arrays(pa.array(np.ascontiguousarray(values).reshape(-1)), int(np.prod(values.shape[1:])))
+                else:
+                    fields[name] = pa.array(values)
+                if name == 'body' and labelNames is not None:
+                    fields['label'] = pa.DictionaryArray.from_arrays(pa.array(labelIndex[values]), dictionary)
+            table = pa.table(fields)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema.with_metadata({'trajectories': json.dumps(metadata)}))
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
@@ -0,0 +1,85 @@
+import numpy as np
+
+class DriftError(RuntimeError):
+    """ Raised when the energy drift recorded by the diagnostics exceeds their threshold; the simulation keeps the steps calculated up to that point"""
+
+    def __init__(self, message, diagnostics):
+        super().__init__(message)
+        self.diagnostics = diagnostics
+
+class Diagnostics():
+    """
+    Time series of the conserved quantities of a simulation, recorded every few steps while it runs.
+
+    Takes the following variables as initialization values:
+        - every: Number of steps between two records
+            int
+        - drift_threshold: Largest relative drift of the energy, |E - E0| / |E0|, that is accepted; when it is exceeded, DriftError is raised and the run stops.
+          When not provided, there is no limit
+            float
+
+    Each recorded quantity is returned as an array by indexing, e.g. diagnostics['energy'] or diagnostics['angular_momentum'] ([record, coordinate]),
+    and the times of the records are in diagnostics.time.
+    """
+
+    def __init__(self, every, drift_threshold = None):
+        if every < 1:
+            raise ValueError('The diagnostics must be recorded every 1 or more steps')
+        self.every = every
+        self.drift_threshold = drift_threshold
+        self.times = []
+        self.records = {}
+
+    @property
+    def time(self):
+        return np.array(self.times)
+
+    def __getitem__(self, quantity):
+        return np.array(self.records[quantity])
+
+    def quantities(self):
+        """ Names of the recorded quantities"""
+        return list(self.records)
+
+    def record(self, time, **values):
+        """ Adds the values of the quantities at one time, and checks the energy drift against the threshold"""
+        self.times.append(time)
+        for quantity, value in values.items():
+            self.records.setdefault(quantity, []).append(value)
+
+        if self.drift_threshold is not None:
+            energy = self.records['energy']
+            drift = abs(energy[-1] - energy[0]) / abs(energy[0]) if energy[0] else abs(energy[-1])
+            if drift > self.drift_threshold:
+                raise DriftError(f'The relative energy drift {drift:.3e} exceeded the threshold {self.drift_threshold:.3e} at t = {time}', self)
+
+    def drift(self, quantity = 'energy'):
+        """ Change of a quantity relative to its first record: (q - q0) / |q0| for scalars and |q - q0| / |q0| for vectors (not divided when q0 is zero)"""
+        values = self[quantity]
+        change = values - values[0]
+        if values.ndim > 1:
+            change = np.linalg.norm(change, axis=1)
+            scale = np.linalg.norm(values[0])
+        else:
+            scale = abs(values[0])
+        return change / scale if scale else change
+
+    def toArrays(self):
+        """ Arrays with the settings and the records, as saved in the checkpoint files"""
+        data = {'diagnostics_every': self.every, 'diagnostics_threshold': np.nan if self.drift_threshold is None else self.drift_threshold,
+                'diagnostics_time': self.time}
+        data.update({f'diagnostics_{quantity}': self[quantity] for quantity in self.records})
+        return data
+
+    @classmethod
+    def fromArrays(cls, data):
+        """ Recreates the diagnostics saved by toArrays, or returns None when data has none"""
+        if 'diagnostics_every' not in data:
+            return None
+        threshold = data['diagnostics_threshold'].item()
+        diagnostics = cls(data['diagnostics_every'].item(), None if np.isnan(threshold) else threshold)
+        diagnostics.times = list(data['diagnostics_time'])
+        for key in data:
+            if key.startswith('diagnostics_') and key not in ('diagnostics_every', 'diagnostics_threshold', 'diagnostics_time'):
+                diagnostics.records[key[len('diagnostics_'):]] = list(data[key])
+        return diagnostics
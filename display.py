@@ -1,76 +1,171 @@
 ################## Plotting #######################
 #Should we made the plot in a different class/function?
 # To make this we will need to define a default output for each simmulation and then create a plot method that accepts this pattern
+import os
+import subprocess
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib.widgets import Slider, Button
 from matplotlib.animation import FuncAnimation
+from matplotlib.lines import Line2D
+from matplotlib.colors import to_rgba
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.image import imsave
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
+from concurrent.futures import ProcessPoolExecutor
+from pyramid import TrajectoryPyramid
+from profiling import NULL_TIMER
 
-def show(classObject, dtStepPerFrame, use_lines = False, **kwargs):
-    #creating the scene
-    fig = plt.figure()
+#Above this number of bodies the legend is not drawn
+LEGEND_MAX_BODIES = 20
+
+#Default size (width, height) in pixels and resolution of the exported frames
+RESOLUTION = (1920, 1080)
+DPI = 100
+
+#Name of the image files written by exportFrames, numbered from 0
+FRAME_NAME = 'frame_{:06d}.png'
+
+#Largest distance, in pixels at the current zoom, between two consecutive points of a trail; coarser levels of the pyramid are read when it allows
+TRAIL_PIXELS = 2
+
+def getPyramid(classObject):
+    """ Returns the multi-resolution trajectory of a simulation, building it on the first display (the simulations reset it when their samples change)"""
+    if getattr(classObject, 'pyramid', None) is None:
+        classObject.pyramid = TrajectoryPyramid(classObject.positions)
+    return classObject.pyramid
+
+def createScene(classObject, fig, use_lines = False, trail_length = 0):
+    """
+    Draws the bodies of a simulation, at their first stored sample, in a new 3D axes of the given figure.
+    Returns the axes, the list of artists that change between frames and the function drawFrame(timeIndex), which moves them to another stored sample and returns them.
+    """
     ax = fig.add_subplot(111, projection='3d')
     ax.set_xlabel('X')
     ax.set_ylabel('Y')
     ax.set_zlabel('Z')
-    frameStep = dtStepPerFrame
+    sampleDt = classObject.dt * getattr(classObject, 'save_every', 1) #time between two stored samples
+    pyramid = getPyramid(classObject)
+    trailSamples = int(round(trail_length / sampleDt))
 
     # setting limits for the axes
-    MaxAxisValue = np.max(np.abs(classObject.positions))
+    MaxAxisValue = pyramid.extent
     ax.set_xlim(-MaxAxisValue, MaxAxisValue) 
     ax.set_ylim(-MaxAxisValue, MaxAxisValue)  
     ax.set_zlim(-MaxAxisValue, MaxAxisValue)
 
-    #plotting the bodies in their stating position
-    bodiesPlot = np.full(classObject.numOfBodies, None, dtype=object)
-    for i in range(classObject.numOfBodies):
-        x, y, z = classObject.positions[i,:,0]
-        bodiesPlot[i], = ax.plot([x], [y], [z], 'o', label=classObject.bodies[i].label, markersize = classObject.bodies[i].size)
-
-    #adding a slider to control the time in the simmulation
-    axcolor = 'lightgoldenrodyellow'
-    axSlider = plt.axes([0.2, 0.02, 0.65, 0.03], facecolor=axcolor)
-    slider = Slider(axSlider, 'Time', classObject.time[0], classObject.time[-1], valinit=classObject.time[0], valstep=classObject.dt)
+    #plotting all the bodies in their stating position as a single collection
+    colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    bodyColors = [colors[i % len(colors)] for i in range(classObject.numOfBodies)]
+    sizes = classObject.bodies.sizes if hasattr(classObject.bodies, 'sizes') else np.array([body.size for body in classObject.bodies], dtype=float)
+    #the bodies removed by collisions (NaN) are masked instead of dropped, so the collection always has one point per body
+    x, y, z = np.nan_to_num(pyramid.sample(0)).T
+    bodiesPlot = ax.scatter(x, y, z, s=sizes**2, c=bodyColors, depthshade=False)
+    handles = []
 
+    artists = [bodiesPlot]
+    if trailSamples:
+        #fading trails: one collection with the segments of all bodies, more transparent the older they are
+        bodyRGBA = np.array([to_rgba(color) for color in bodyColors])
+        trails = Line3DCollection([np.zeros((2, 3))], linewidths=1)
+        ax.add_collection3d(trails)
+        artists.append(trails)
     if use_lines:
         line, = ax.plot([], [], [], color='black', linestyle='-', linewidth=2)
         line_zero_to_body, = ax.plot([], [], [], color='black', linewidth=2)
         center_body, = ax.plot([0], [0], [0], 'o', color='black',label='Origin Body', markersize=10)
+        artists += [line, line_zero_to_body]
+        handles.append(center_body)
 
-    #conect the function updateDisplay to when the slider is changed
-    def updateDisplay(val):
-        for i in range(classObject.numOfBodies):
-            timeIndex, = np.where(abs(classObject.time - float(slider.val)) < 1e-10)[0]
-            x, y, z = classObject.positions[i,:,timeIndex]
-            bodiesPlot[i].set_data([x], [y])
-            bodiesPlot[i].set_3d_properties([z])
+    if classObject.numOfBodies <= LEGEND_MAX_BODIES:
+        bodyHandles = [Line2D([], [], marker='o', linestyle='', color=bodyColors[i], markersize=sizes[i], label=classObject.bodies[i].label) for i in range(classObject.numOfBodies)]
+        ax.legend(handles=bodyHandles + handles)
+
+    def drawFrame(timeIndex):
+        """ Moves every artist to one stored sample, reading the positions of all bodies in a single slice of the coarsest level of the pyramid that holds it"""
+        x, y, z = np.ma.masked_invalid(pyramid.sample(timeIndex)).T
+        bodiesPlot._offsets3d = (x, y, z)
+
+        if trailSamples:
+            #the trail detail follows the zoom: the span of the x axis, which changes when the user zooms, over the width of the axes in pixels
+            xmin, xmax = ax.get_xlim()
+            tolerance = TRAIL_PIXELS * (xmax - xmin) / max(ax.bbox.width, 1)
+            points = pyramid.trail(timeIndex, trailSamples, tolerance=tolerance).transpose(0, 2, 1)
+            numSegments = points.shape[1] - 1
+            trails.set_segments(np.stack([points[:, :-1], points[:, 1:]], axis=2).reshape(-1, 2, 3))
+            colors = np.repeat(bodyRGBA[:, None, :], numSegments, axis=1)
+            colors[:, :, 3] = np.linspace(0, 1, numSegments + 1)[1:]
+            trails.set_color(colors.reshape(-1, 4))
 
          # Update the line connecting the bodies
         if use_lines:
-            x_line = classObject.positions[:, 0, timeIndex]
-            y_line = classObject.positions[:, 1, timeIndex]
-            z_line = classObject.positions[:, 2, timeIndex]
-            line.set_data(x_line, y_line)
-            line.set_3d_properties(z_line)
-            x_zero_to_body = [0, classObject.positions[0, 0, timeIndex]]
-            y_zero_to_body = [0, classObject.positions[0, 1, timeIndex]]
-            z_zero_to_body = [0, classObject.positions[0, 2, timeIndex]]
-            line_zero_to_body.set_data(x_zero_to_body, y_zero_to_body)
-            line_zero_to_body.set_3d_properties(z_zero_to_body)
-           
+            line.set_data_3d(x, y, z)
+            line_zero_to_body.set_data_3d([0, x[0]], [0, y[0]], [0, z[0]])
+        return artists
+
+    return ax, artists, drawFrame
+
+def projectArtists(artists):
+    """ Projects the 3D artists on the current view of their axes, which only a full draw of the axes does, so they can be drawn alone (blitting)"""
+    for artist in artists:
+        if hasattr(artist, 'do_3d_projection'):
+            artist.do_3d_projection()
+
+def show(classObject, dtStepPerFrame, use_lines = False, trail_length = 0, **kwargs):
+    #creating the scene
+    fig = plt.figure()
+    ax, artists, drawFrame = createScene(classObject, fig, use_lines, trail_length)
+    frameStep = dtStepPerFrame
+    numFrames = classObject.positions.shape[2]
+    currentFrame = 0
+    sampleDt = classObject.dt * getattr(classObject, 'save_every', 1) #time between two stored samples
+
+    #adding a slider to control the time in the simmulation
+    axcolor = 'lightgoldenrodyellow'
+    axSlider = plt.axes([0.2, 0.02, 0.65, 0.03], facecolor=axcolor)
+    slider = Slider(axSlider, 'Time', classObject.time[0], classObject.time[-1], valinit=classObject.time[0], valstep=sampleDt)
+    slider.drawon = False #the slider is redrawn together with the other animated artists
+    #the value of the slider is shown in an axes of its own, since blitting only restores the background inside the axes of each artist
+    slider.valtext.set_visible(False)
+    axTime = plt.axes([0.863, 0.02, 0.12, 0.03])
+    axTime.set_axis_off()
+    timeText = axTime.text(0, 0.5, slider.valtext.get_text(), verticalalignment='center')
+    sliderArtists = [artist for artist in (slider.poly, getattr(slider, '_handle', None), timeText) if artist is not None]
+
+    def frameIndex(value):
+        """ Index of the stored sample closest to a time value, calculated directly from the sample spacing"""
+        return int(np.clip(round((value - classObject.time[0]) / sampleDt), 0, numFrames - 1))
+
+    #conect the function updateDisplay to when the slider is changed by the user
+    def updateDisplay(val):
+        nonlocal currentFrame
+        currentFrame = frameIndex(float(val))
+        drawFrame(currentFrame)
+        timeText.set_text(slider.valtext.get_text())
         fig.canvas.draw_idle()
     slider.on_changed(updateDisplay)
 
-    #creating the animation to update the slider by time
-    def updateSlider(num, slider):
-        val = slider.val
-        val += frameStep*classObject.dt 
-        if val > slider.valmax:
-            val = slider.valmin
-        slider.set_val(val)
+    #creating the animation to update the slider by time; only the animated artists are redrawn (blitting)
+    def updateSlider(num):
+        nonlocal currentFrame
+        currentFrame += frameStep
+        if currentFrame >= numFrames:
+            currentFrame = 0
+        slider.eventson = False
+        slider.set_val(classObject.time[currentFrame])
+        slider.eventson = True
+        timeText.set_text(slider.valtext.get_text())
+        artists = drawFrame(currentFrame)
+        projectArtists(artists)
+        return artists + sliderArtists
 
-    ani = FuncAnimation(fig, updateSlider, fargs=(slider,), interval=1000/60, frames=classObject.numIterations, cache_frame_data=False)
+    #the animated artists are left out of the cached background, so their previous state is not drawn under the new one
+    for artist in artists + sliderArtists:
+        artist.set_animated(True)
+    ani = FuncAnimation(fig, updateSlider, interval=1000/60, blit=True, cache_frame_data=False)
 
  # Adding play/pause button
     axPlayPause = plt.axes([0.1, 0.1, 0.1, 0.04])
@@ -87,8 +182,120 @@ def show(classObject, dtStepPerFrame, use_lines = False, **kwargs):
 
     playPauseButton.on_clicked(togglePlayPause)
 
-    ax.legend()
     plt.show()
+    return ani
+
+################## Headless export #######################
+
+def renderFrames(classObject, frames, resolution = RESOLUTION, dpi = DPI, use_lines = False, trail_length = 0):
+    """
+    Renders the given stored samples without any window, with the Agg backend, yielding each image as a [height, width, 4] array of RGBA bytes.
+    The array is the buffer of the canvas, so it is overwritten by the next frame.
+    The static part of the figure (axes, labels and legend) is drawn once, and only the moving artists are drawn over it for each frame.
+    """
+    fig = Figure(figsize=(resolution[0] / dpi, resolution[1] / dpi), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax, artists, drawFrame = createScene(classObject, fig, use_lines, trail_length)
+    timeText = fig.text(0.02, 0.96, '')
+    artists = artists + [timeText]
+    for artist in artists:
+        artist.set_animated(True)
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+
+    timer = getattr(classObject, 'timer', NULL_TIMER)
+    for timeIndex in frames:
+        with timer.phase('render_frame'):
+            drawFrame(timeIndex)
+            timeText.set_text(f'Time = {classObject.time[timeIndex]:.4g}')
+            canvas.restore_region(background)
+            projectArtists(artists)
+            for artist in artists:
+                fig.draw_artist(artist)
+        yield np.asarray(canvas.buffer_rgba())
+
+def writeFrames(classObject, frames, directory, firstNumber, **renderArgs):
+    """ Renders the given stored samples to numbered PNG files in the directory, starting from firstNumber"""
+    for number, image in enumerate(renderFrames(classObject, frames, **renderArgs), firstNumber):
+        imsave(os.path.join(directory, FRAME_NAME.format(number)), image)
+
+def encodeVideo(classObject, frames, path, fps, codec = 'libx264', ffmpeg = 'ffmpeg', **renderArgs):
+    """ Renders the given stored samples and streams the raw frames to the standard input of an ffmpeg process, which encodes them to the video file path"""
+    process = None
+    try:
+        for image in renderFrames(classObject, frames, **renderArgs):
+            if process is None:
+                height, width = image.shape[:2]
+                process = subprocess.Popen([ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', f'{width}x{height}', '-r', str(fps),
+                                            '-i', '-', '-an', '-vcodec', codec, '-pix_fmt', 'yuv420p', path], stdin=subprocess.PIPE)
+            process.stdin.write(image.data)
+    finally:
+        if process is not None:
+            process.stdin.close()
+            if process.wait():
+                raise RuntimeError(f'ffmpeg exited with code {process.returncode} while writing {path}')
+
+#Simulation rendered by the current worker process, set once when the worker starts
+workerScene = None
+
+def setWorkerScene(classObject):
+    global workerScene
+    workerScene = classObject
+
+def renderInWorker(function, *args, **kwargs):
+    return function(workerScene, *args, **kwargs)
+
+def animationFrames(classObject, dtStepPerFrame):
+    """ Indices of the stored samples shown in an animation that skips dtStepPerFrame samples per frame"""
+    return np.arange(0, classObject.positions.shape[2], dtStepPerFrame)
+
+def splitFrames(frames, workers):
+    """ Splits the frames into one contiguous range per worker, as (frames, number of the first frame) pairs"""
+    parts = np.array_split(frames, workers)
+    return list(zip(parts, np.cumsum([0] + [len(part) for part in parts[:-1]]).tolist()))
+
+def runParts(classObject, function, parts, workers, **kwargs):
+    """ Calls function(classObject, frames, *args, **kwargs) for each (frames, args) part, in worker processes when workers > 1"""
+    getPyramid(classObject) #built once, before the workers are started
+    if workers <= 1:
+        for frames, args in parts:
+            function(classObject, frames, *args, **kwargs)
+        return
+    #With fork, the workers inherit the simulation instead of receiving a pickled copy of its samples
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=setWorkerScene, initargs=(classObject,)) as pool:
+        for future in [pool.submit(renderInWorker, function, frames, *args, **kwargs) for frames, args in parts]:
+            future.result()
+
+def exportFrames(classObject, directory, dtStepPerFrame = 1, workers = 1, **renderArgs):
+    """ Writes one PNG file per frame of the animation to the directory, with the frames split in contiguous ranges between the worker processes"""
+    os.makedirs(directory, exist_ok=True)
+    parts = [(frames, (directory, first)) for frames, first in splitFrames(animationFrames(classObject, dtStepPerFrame), workers)]
+    runParts(classObject, writeFrames, parts, workers, **renderArgs)
+
+def exportVideo(classObject, path, fps = 30, dtStepPerFrame = 1, workers = 1, codec = 'libx264', ffmpeg = 'ffmpeg', **renderArgs):
+    """
+    Encodes the animation to a video file with ffmpeg. With more than one worker, each process encodes a contiguous range of frames to a
+    temporary segment, and the segments are joined without re-encoding.
+    """
+    frames = animationFrames(classObject, dtStepPerFrame)
+    if workers <= 1:
+        runParts(classObject, encodeVideo, [(frames, (path, fps))], 1, codec=codec, ffmpeg=ffmpeg, **renderArgs)
+        return
+
+    base, extension = os.path.splitext(path)
+    segments = [f'{base}.part{index}{extension}' for index in range(workers)]
+    parts = [(part, (segment, fps)) for (part, first), segment in zip(splitFrames(frames, workers), segments) if len(part)]
+    listPath = f'{base}.parts.txt'
+    try:
+        runParts(classObject, encodeVideo, parts, workers, codec=codec, ffmpeg=ffmpeg, **renderArgs)
+        with open(listPath, 'w') as file:
+            file.writelines(f"file '{os.path.abspath(segment)}'\n" for frames, (segment, fps) in parts)
+        subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', listPath, '-c', 'copy', path], check=True)
+    finally:
+        for segment in segments + [listPath]:
+            if os.path.exists(segment):
+                os.remove(segment)
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,163 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+#Maximum number of pairwise interactions evaluated at once by the direct kernel (bounds the (block, n, 3) temporary to ~50 MB)
+PAIRS_PER_BLOCK = 2**21
+
+@lru_cache(maxsize=None)
+def threadPool(workers):
+    """ Pool of threads shared by all force evaluations with the same number of workers (the NumPy operations of the kernels release the GIL, so the threads run in parallel)"""
+    return ThreadPoolExecutor(max_workers=workers)
+
+#The threads of a pool do not exist in the processes forked after it was created (sweep and video export workers), so those start without any cached pool
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=threadPool.cache_clear)
+
+def directAccelerations(positions, masses, G, softening = 0, blockSize = None, targets = None, workers = 1, potential = False):
+    """
+    Calculates the gravitational acceleration of every body by direct summation over all pairs, using broadcasted NumPy operations.
+
+    Takes the following variables as input:
+        - positions: Positions of the bodies
+            array of shape [numOfBodies, 3]
+        - masses: Masses of the bodies
+            array of shape [numOfBodies] or [numOfBodies, 1]
+        - G: Gravitational constant
+            numerical value as int or float
+        - softening: Plummer softening length; the interaction uses 1/(r² + softening²)^(3/2) instead of 1/r³
+            numerical value as int or float
+        - blockSize: Number of bodies (rows) evaluated per pass; when not provided, it is chosen so that each pass handles at most PAIRS_PER_BLOCK interactions
+            int
+        - targets: Indexes of the bodies whose accelerations are calculated (the forces still come from all bodies); when not provided, all bodies are used
+            array of int
+        - workers: Number of threads; the targets are split among them and each one calculates the accelerations of its own bodies
+            int
+        - potential: Whether the potential energy is also calculated, from the same pairwise distances (-G/2 * sum over the targets i and all bodies j of m_i*m_j/r_ij,
+          which is the total potential energy when all bodies are targets)
+            bool
+
+    Returns an array of shape [numOfTargets, 3] with the resulting accelerations, or a tuple (accelerations, potential energy) when potential is True.
+    """
+    positions = np.asarray(positions)
+    masses = np.asarray(masses).reshape(-1)
+    if targets is None:
+        targets = np.arange(positions.shape[0])
+
+    if workers > 1 and len(targets) > 1:
+        if blockSize is None:
+            blockSize = max(1, PAIRS_PER_BLOCK // (max(positions.shape[0], 1) * workers))
+        pieces = np.array_split(targets, min(workers, len(targets)))
+        results = list(threadPool(workers).map(lambda piece: directAccelerations(positions, masses, G, softening, blockSize, piece, potential=potential), pieces))
+        if potential:
+            return np.concatenate([result[0] for result in results]), sum(result[1] for result in results)
+        return np.concatenate(results)
+
+    accelerations = np.zeros((len(targets), 3), dtype=positions.dtype)
+    energy = 0.0
+
+    for start, stop, rows, r, invDist3 in _pairBlocks(positions, targets, softening, blockSize):
+        accelerations[start:stop] = G * np.einsum('ij,ijk->ik', invDist3 * masses[np.newaxis, :], r)
+        if potential:
+            energy += np.sum(masses[rows] * (np.cbrt(invDist3) @ masses))
+
+    if potential:
+        return accelerations, -G * energy / 2 #cada par foi somado duas vezes
+    return accelerations
+
+def directJerks(positions, velocities, masses, G, softening = 0, blockSize = None, targets = None):
+    """
+    Calculates the time derivative of the gravitational acceleration (jerk) of the bodies by direct summation over all pairs.
+
+    Takes the same inputs as directAccelerations, plus:
+        - velocities: Velocities of the bodies
+            array of shape [numOfBodies, 3]
+
+    Returns an array of shape [numOfTargets, 3] with the jerks.
+    """
+    positions = np.asarray(positions)
+    velocities = np.asarray(velocities)
+    masses = np.asarray(masses).reshape(-1)
+    if targets is None:
+        targets = np.arange(positions.shape[0])
+    jerks = np.zeros((len(targets), 3), dtype=positions.dtype)
+
+    for start, stop, rows, r, invDist3 in _pairBlocks(positions, targets, softening, blockSize):
+        v = velocities[np.newaxis, :, :] - velocities[rows, np.newaxis, :]
+        rv = np.einsum('ijk,ijk->ij', r, v)
+        invDist2 = invDist3**(2/3)
+        weight = invDist3 * masses[np.newaxis, :]
+        jerks[start:stop] = G * (np.einsum('ij,ijk->ik', weight, v) - 3 * np.einsum('ij,ijk->ik', weight * rv * invDist2, r))
+
+    return jerks
+
+def directPotential(positions, masses, G, softening = 0, blockSize = None):
+    """ Calculates the total gravitational potential energy, -G * sum over pairs of m_i*m_j/(r² + softening²)^(1/2)"""
+    positions = np.asarray(positions)
+    masses = np.asarray(masses).reshape(-1)
+    potential = 0.0
+
+    for start, stop, rows, r, invDist3 in _pairBlocks(positions, np.arange(positions.shape[0]), softening, blockSize):
+        potential += np.sum(masses[rows] * (np.cbrt(invDist3) @ masses))
+
+    return -G * potential / 2 #cada par foi somado duas vezes
+
+def minimumSeparation(positions, blockSize = None):
+    """ Returns the smallest distance between two of the given bodies"""
+    positions = np.asarray(positions)
+    closest = np.inf
+
+    for start, stop, rows, r, invDist3 in _pairBlocks(positions, np.arange(positions.shape[0]), 0, blockSize):
+        closest = min(closest, np.min(np.sqrt(np.einsum('ijk,ijk->ij', r, r))[invDist3 > 0], initial=np.inf))
+
+    return closest
+
+def _pairBlocks(positions, targets, softening, blockSize):
+    """ Yields, for each block of targets, the displacements r_ij = x_j - x_i and the factors 1/(r² + softening²)^(3/2), with the self interactions set to zero"""
+    eps2 = softening**2
+    if blockSize is None:
+        blockSize = max(1, PAIRS_PER_BLOCK // max(positions.shape[0], 1))
+
+    for start in range(0, len(targets), blockSize):
+        stop = min(start + blockSize, len(targets))
+        rows = targets[start:stop]
+
+        r = positions[np.newaxis, :, :] - positions[rows, np.newaxis, :] #Vetores distância r_ij = x_j - x_i
+        dist2 = np.einsum('ijk,ijk->ij', r, r) + eps2
+
+        with np.errstate(divide='ignore'):
+            invDist3 = dist2**-1.5
+        invDist3[np.arange(stop - start), rows] = 0 #Remove a interação de cada corpo com ele mesmo
+
+        yield start, stop, rows, r, invDist3
+
+def strongScalingReport(sizes = (1000, 5000, 20000, 50000), workerCounts = None, repeats = 1):
+    """ Prints the time of one force evaluation of the direct and Barnes-Hut kernels, and the speedup over one worker, as the number of workers grows"""
+    from barnesHut import barnesHutAccelerations
+
+    if workerCounts is None:
+        workerCounts = [2**k for k in range(int(np.log2(os.cpu_count() or 1)) + 1)]
+        if workerCounts[-1] != os.cpu_count():
+            workerCounts.append(os.cpu_count())
+
+    kernels = {'direct': directAccelerations, 'barnes_hut': barnesHutAccelerations}
+    print(f'Strong scaling ({os.cpu_count()} cores available)')
+    print(f'{"kernel":>10} {"n":>7} {"workers":>8} {"time [s]":>10} {"speedup":>8}')
+    for numOfBodies in sizes:
+        rng = np.random.default_rng(0)
+        positions = rng.normal(size=(numOfBodies, 3))
+        masses = np.full(numOfBodies, 1 / numOfBodies)
+        for name, kernel in kernels.items():
+            for workers in workerCounts:
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    kernel(positions, masses, 1, 1e-3, workers=workers)
+                elapsed = (time.perf_counter() - start) / repeats
+                if workers == workerCounts[0]:
+                    reference = elapsed * workers
+                print(f'{name:>10} {numOfBodies:7d} {workers:8d} {elapsed:10.3f} {reference / elapsed:8.2f}')
+
+if __name__ == "__main__":
+    strongScalingReport()
@@ -1,130 +1,666 @@
+import os
 import numpy as np
-import pandas as pd
-from itertools import product
-from tqdm import tqdm
-from body import CreateBodyGrav
-from display import show
+from body import BodySet
+from forces import directAccelerations, directJerks, directPotential
+from barnesHut import barnesHutAccelerations
+from storage import TrajectoryStore, QUANTITIES
+from integrators import getIntegrator
+from columnar import exportTrajectories, longColumns
+from diagnostics import Diagnostics
+from collisions import MODES, overlappingPairs, mergeBodies, bounceBodies
+from profiling import PhaseTimer, NULL_TIMER
+from precision import getPrecision, CompensatedArray
+#pandas, tqdm and the display module (matplotlib) are imported only by the methods that use them, so the simulations start quickly in the sweep workers
+
+#Number of consecutive steps kept in memory during the simulation (the integrators only need the previous one)
+RING_SIZE = 2
+
+#Name of each stored quantity in the columns of exportDF
+COLUMN_NAMES = {'positions': 'position', 'velocities': 'velocity', 'accelerations': 'acceleration'}
+
+#Layouts of the dataframes returned by exportDF
+DF_LAYOUTS = ('wide', 'long')
 
 class GravitySim():
     """
     Creates the simulation scene based on the following inputs:
-        - bodiesArray: Array of Body objects created from the CreateBody class
-            [body1, body2, ...]
+        - bodiesArray: Array of Body objects created from the CreateBody class, or a BodySet, which is used without copying each body
+            [body1, body2, ...] or BodySet
         - G: Corresponds to the gravitational constant; when not provided, defaults to the value of the constant in the SI unit
             numerical value as int or float
+        - softening: Plummer softening length used to avoid the divergence of the force in close encounters; defaults to 0 (pure Newtonian force)
+            numerical value as int or float
+        - force_method: Corresponds to the method used to calculate the gravitational forces; it can be one of the following:
+            "direct": exact sum over all pairs of bodies, O(n²) per step
+            "barnes_hut": Barnes-Hut approximation using an octree rebuilt every step, O(n log n) per step
+        - theta: Opening angle of the Barnes-Hut approximation; smaller values are more accurate and slower
+            numerical value as int or float
+        - workers: Number of threads used to calculate the forces; the bodies are split among them
+            int
+        - collisions: When given, the size of each body is its radius and the bodies that overlap at the end of a step collide (fixed step methods only):
+            "merge": the bodies join into the most massive one, conserving the mass, the momentum and the volume (perfectly inelastic); the others are removed
+            "bounce": the relative velocity of the bodies along the line between their centres is reflected and multiplied by the restitution
+          Removed bodies keep their rows in the stored samples, filled with NaN, and each collision is listed in collisionEvents
+            str
+        - restitution: Coefficient of restitution of the "bounce" collisions; 1 for elastic collisions, which conserve the kinetic energy
+            numerical value as int or float
+        - precision: Floating point types used by the simulation (see precision.PRECISIONS):
+            "double": everything in float64
+            "mixed": the state is integrated in float64, the forces are evaluated and the samples stored in float32
+            "single": everything in float32
+            "extended": everything in the long double of the platform (80 bits on x86); slow, used as reference for the rounding errors of the others
+            str
+        - compensated: Whether the positions and velocities are updated with compensated (Kahan) sums, which keep the rounding errors of each step
+          and add them back in the next one, so long runs lose less precision (fixed step methods without block time steps only)
+            bool
 
     """
 
-    def __init__(self, bodiesArray, G = 6.6743e-11):
-        self.bodies = bodiesArray
+    def __init__(self, bodiesArray, G = 6.6743e-11, softening = 0, force_method = 'direct', theta = 0.5, workers = 1, collisions = None, restitution = 1, precision = 'double',
+                 compensated = False):
+        if force_method not in ('direct', 'barnes_hut'):
+            raise ValueError(f'Unknown force method "{force_method}", use "direct" or "barnes_hut"')
+        if collisions is not None and collisions not in MODES:
+            raise ValueError(f'Unknown collision mode "{collisions}", use one of: {", ".join(MODES)}')
+
+        self.bodies = bodiesArray if isinstance(bodiesArray, BodySet) else BodySet.fromBodies(bodiesArray)
         self.numOfBodies = len(self.bodies)
         
         self.G = G
+        self.softening = softening
+        self.force_method = force_method
+        self.theta = theta
+        self.workers = workers
+        self.collisions = collisions
+        self.restitution = restitution
+        self.precision = getPrecision(precision)
+        self.compensated = compensated
+        self.collisionEvents = [] #(time, body, other body) of each collision; with "merge", other body is the one absorbed by body
+
+        self.diagnostics = None
+        self.measurePotential = False #when set, the force evaluations of all bodies also return the potential energy, kept in lastPotential
+        self.lastPotential = None
+        self.timer = NULL_TIMER
 
-    def simulate(self, timeInterval, dt = 1, method = 'verlet'):
+    def simulate(self, timeInterval, dt = 1, method = 'verlet', save_every = 1, storage = None, rtol = 1e-8, atol = 1e-10, block_levels = 0, eta = 0.02, progress = True,
+                 checkpoint = None, checkpoint_every = 10000, diagnostics_every = 0, drift_threshold = None):
         """
     Calculates all simulation intervals within a given time range.
     
     Takes the following variables as input:
         - timeInterval: A list containing the initial and final time for which the simulation will be conducted
             [initial_time, final_time]
-        - dt: Time step to be used during the process
+        - dt: Time step to be used during the process (for the adaptive methods, the size of the first step)
             numerical value as int or float
-        - method: Corresponds to the method that will be used to calculate the positions of the bodies in the simulation; it can be one of the following:
-            "verlet": performs calculations using the Verlet integration
+        - method: Corresponds to the method that will be used to calculate the positions of the bodies in the simulation; it can be any method of the integrators registry:
+            "verlet" or "leapfrog": performs calculations using the velocity Verlet integration
             "eqMov": performs calculations using the equations of motion
+            "yoshida4": fourth order symplectic integration of Yoshida
+            "euler", "rk4": explicit Euler and fourth order Runge-Kutta methods
+            "rk45": Dormand-Prince method with adaptive step size; the solution is interpolated at the requested time steps
+        - save_every: Only one of every save_every steps is stored in positions/velocities/accelerations/time
+            int
+        - storage: Folder where the stored steps are written as memory-mapped .npy files; when not provided, they are kept in memory
+            str
+        - rtol, atol: Relative and absolute tolerances of the local error, used only by the adaptive methods
+            numerical value as int or float
+        - block_levels: When greater than zero, each body takes its own time step dt/2**k, with k between 0 and block_levels, chosen from its acceleration and jerk
+          (hierarchical block time steps with the kick-drift-kick leapfrog; only "verlet"/"leapfrog" can be used). dt is then the largest step, and all bodies are synchronized at every dt.
+            int
+        - eta: Accuracy parameter of the block time steps; the step of each body is at most eta*|acceleration|/|jerk|
+            numerical value as int or float
+        - progress: Whether the progress bar of the simulation is shown
+            bool
+        - checkpoint: File where save_checkpoint is called every checkpoint_every steps (fixed step methods only), so the run can be restarted with load_checkpoint after a crash.
+          When the samples are kept in memory, every checkpoint rewrites all the samples stored so far; for long runs, use storage so only the last state is written
+            str
+        - checkpoint_every: Number of steps between two checkpoints
+            int
+        - diagnostics_every: When greater than zero, the energy (kinetic, potential and total), the linear momentum and the angular momentum are recorded every
+          diagnostics_every steps in self.diagnostics (see the Diagnostics class). The potential energy comes from the force evaluation of the step, so with Barnes-Hut
+          it is the potential of the tree, with the error of the approximation
+            int
+        - drift_threshold: Largest relative energy drift accepted by the diagnostics; when it is exceeded, the run stops with a DriftError
+            numerical value as int or float
 
         """
+        self.integrator = getIntegrator(method)
+        if block_levels and method not in ('verlet', 'leapfrog'):
+            raise ValueError('Block time steps can only be used with the "verlet" or "leapfrog" methods')
+        if self.collisions is not None and self.integrator.adaptive:
+            raise ValueError('Collisions can only be used with fixed step methods')
+        if self.compensated and (self.integrator.adaptive or block_levels):
+            raise ValueError('Compensated sums can only be used with fixed step methods without block time steps')
+
+        self.method = method
+        self.rtol = rtol
+        self.atol = atol
+        self.blockLevels = block_levels
+        self.eta = eta
+        self.progress = progress
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.diagnostics = Diagnostics(diagnostics_every, drift_threshold) if diagnostics_every else None
 
         self.dt = dt
-        self.time = np.arange(timeInterval[0], timeInterval[1]+self.dt, self.dt)
-        self.numIterations = len(self.time)
-        
-        #Initializes the creation of variables where all calculated values throughout the simulation will be stored.
-        self.positions = np.zeros([self.numOfBodies, 3, self.numIterations])
-        self.velocities = np.zeros([self.numOfBodies, 3, self.numIterations])
-        self.accelerations = np.zeros([self.numOfBodies, 3, self.numIterations])
-        self.masses = np.zeros((self.numOfBodies,1))
+        self.save_every = save_every
+        self.steps = np.arange(timeInterval[0], timeInterval[1]+self.dt, self.dt)
+        self.numSteps = len(self.steps)
+        self.numForceEvaluations = 0
+
+        #Initializes the creation of variables where the saved values of the simulation will be stored
+        self.store = TrajectoryStore(self.steps[::save_every], self.numOfBodies, storage, dtype=self.precision.storeDtype)
+        self.updateViews()
+
+        #Only the current and the previous steps are kept during the simulation ([step % RING_SIZE, body, coordinate]).
+        #These arrays hold only the bodies that were not removed by collisions, which are the bodies self.alive of the stored samples
+        self.alive = np.arange(self.numOfBodies)
+        self.radii = self.bodies.sizes.copy()
+        self.collisionEvents = []
+        self.ringPositions = np.zeros([RING_SIZE, self.numOfBodies, 3], self.precision.stateDtype)
+        self.ringVelocities = np.zeros([RING_SIZE, self.numOfBodies, 3], self.precision.stateDtype)
+        self.ringAccelerations = np.zeros([RING_SIZE, self.numOfBodies, 3], self.precision.stateDtype)
+        #Rounding errors of the positions and velocities of the current step, added back in the next one when the sums are compensated
+        self.positionError = np.zeros([self.numOfBodies, 3], self.precision.stateDtype)
+        self.velocityError = np.zeros([self.numOfBodies, 3], self.precision.stateDtype)
 
         #Assigning the initial conditions to the variables above
-        for bodyIndex in range(self.numOfBodies):
-            self.masses[bodyIndex,0] = self.bodies[bodyIndex].mass
-            self.positions[bodyIndex, :, 0] = self.bodies[bodyIndex].position
-            self.velocities[bodyIndex, :, 0] = self.bodies[bodyIndex].velocity
-
-        #Loop to calculate the new positions, velocities and accelerations of bodies over the time interval        
-        if method == 'verlet':
-            self.iter = 1
-            self.movementEq()
-            for currentTime in tqdm(range(2,self.numIterations), desc="Simulating"):
-                self.iter = currentTime
-                self.verlet() 
-        elif method == 'eqMov':
-            for currentTime in tqdm(range(1,self.numIterations), desc="Simulating"):
-                self.iter = currentTime
-                self.movementEq()
-    
-    def movementEq(self):
-        """ Calculates new positions from the equations of motion"""        
-        forces = self.calculateForces()
+        self.masses = self.bodies.masses[:, np.newaxis].copy()
+        self.ringPositions[0] = self.bodies.positions
+        self.ringVelocities[0] = self.bodies.velocities
+        self.iter = 0
+        self.measurePotential = self.diagnostics is not None
+        self.ringAccelerations[0] = self.calculateAccelerations()
+
+        if block_levels:
+            if self.force_method == 'direct':
+                jerks = directJerks(self.ringPositions[0], self.ringVelocities[0], self.masses, self.G, self.softening)
+            else:
+                #the exact jerk is an O(n²) sum, so with the tree it is estimated from the change of the accelerations over the smallest substep, as in advanceBlocks
+                h = self.dt / 2**block_levels
+                jerks = (self.calculateAccelerations(self.ringPositions[0] + self.ringVelocities[0] * h) - self.ringAccelerations[0]) / h
+            self.bins = self.timeStepBins(self.ringAccelerations[0], jerks, np.full(self.numOfBodies, self.dt))
+        if self.collisions is not None:
+            self.resolveCollisions(self.steps[0])
+
+        self.nativeTime = np.array([self.steps[0]])
+        with self.timer.phase('store'):
+            self.saveStep()
+        if self.diagnostics is not None:
+            self.measure(self.steps[0], self.ringPositions[0], self.ringVelocities[0])
+        self.run()
+
+    def run(self):
+        """ Loop to calculate the new positions, velocities and accelerations of bodies from the current step up to the last one of self.steps"""
+        try:
+            if self.integrator.adaptive:
+                current = self.step()
+                y = np.stack([self.ringPositions[current], self.ringVelocities[current]])
+                dy = np.stack([self.ringVelocities[current], self.ringAccelerations[current]])
+                outputTimes = self.time[self.store.numSaved:]
+                numSaved = self.store.numSaved
+                try:
+                    if len(outputTimes):
+                        with self.timer.phase('integrate'):
+                            nativeTime = self.integrator.function(self.derivs, self.steps[self.iter], y, dy, outputTimes, self.dt, self.saveState, self.rtol, self.atol)
+                        self.nativeTime = np.concatenate([self.nativeTime, nativeTime[1:]])
+                finally:
+                    #The run continues from the last stored sample, which is the last output of the adaptive method (also when it stopped with an error)
+                    if self.store.numSaved > numSaved:
+                        self.iter = (self.store.numSaved - 1) * self.save_every
+                        y, dy = self.lastState
+                        self.ringPositions[self.step()], self.ringVelocities[self.step()] = y
+                        self.ringAccelerations[self.step()] = dy[1]
+            else:
+                steps = range(self.iter+1,self.numSteps)
+                if self.progress:
+                    from tqdm import tqdm
+                    steps = tqdm(steps, desc="Simulating")
+                for currentTime in steps:
+                    self.iter = currentTime
+                    measured = self.diagnostics is not None and currentTime % self.diagnostics.every == 0
+                    self.measurePotential = measured
+                    with self.timer.phase('integrate'):
+                        if self.blockLevels:
+                            self.advanceBlocks()
+                        else:
+                            self.advance(self.integrator)
+                    if self.collisions is not None:
+                        with self.timer.phase('collisions'):
+                            self.resolveCollisions(self.steps[currentTime])
+                    with self.timer.phase('store'):
+                        self.saveStep()
+                    if measured:
+                        current = self.step()
+                        self.measure(self.steps[currentTime], self.ringPositions[current], self.ringVelocities[current])
+                    if self.checkpoint is not None and currentTime % self.checkpoint_every == 0:
+                        with self.timer.phase('checkpoint'):
+                            self.save_checkpoint(self.checkpoint)
+        finally:
+            #the samples already calculated are kept when the run stops with an error (e.g. DriftError), and the ones planned after them are dropped,
+            #so time, positions, etc. end at the last calculated sample and continue_to appends the new samples right after it
+            self.store.flush()
+            if self.store.numSaved < self.store.numSamples:
+                self.store.dropUnsaved()
+                self.updateViews()
+
+    def continue_to(self, finalTime):
+        """
+        Continues the last simulation, with the same settings, from its last calculated step up to finalTime, appending the new samples to the stored ones.
+        The state needed by the integrators (positions, velocities and accelerations of the last step) is kept, so the result is the same as a single longer simulation.
+        """
+        delta = self.steps[1] - self.steps[0] if len(self.steps) > 1 else self.dt
+        numSteps = int(np.floor((finalTime - self.steps[0]) / delta + 1e-9)) + 1
+        if numSteps <= self.iter + 1:
+            raise ValueError(f'The simulation has already reached t = {self.steps[self.iter]}')
+
+        #Same values that np.arange would give for the whole interval
+        self.steps = np.concatenate([self.steps[:self.iter+1], self.steps[0] + delta * np.arange(self.iter+1, numSteps)])
+        self.numSteps = numSteps
+        firstSaved = -(-(self.iter+1) // self.save_every) * self.save_every
+        #the views of the stored samples are released first, so the files of a storage folder are not mapped while they are resized
+        self.positions = self.velocities = self.accelerations = self.pyramid = None
+        self.store.extend(self.steps[firstSaved::self.save_every])
+        self.updateViews()
+        self.run()
+
+    def extend(self, duration):
+        """ Continues the last simulation for more duration units of time (see continue_to)"""
+        self.continue_to(self.steps[self.iter] + duration)
+
+    def updateViews(self):
+        """ Updates the time array and the [body, coordinate, sample] views of the stored quantities"""
+        self.time = self.store.time
+        self.numIterations = len(self.time)
+        self.positions = self.store.bodyMajor('positions')
+        self.velocities = self.store.bodyMajor('velocities')
+        self.accelerations = self.store.bodyMajor('accelerations')
+        self.pyramid = None #multi-resolution copy of the positions, built by show() when they are first displayed
+
+    def save_checkpoint(self, path):
+        """
+        Saves, in a single .npz file, everything needed to continue the simulation: the bodies, the settings, the state of the last step and,
+        when the samples are kept in memory, the stored samples (samples written to a storage folder stay there and are reopened by load_checkpoint).
+        The file is written next to path and then renamed over it, so a crash while saving keeps the previous checkpoint.
+        """
+        self.store.flush()
+        current = self.step()
+        data = dict(
+            G=self.G, softening=self.softening, force_method=self.force_method, theta=self.theta, workers=self.workers,
+            labelNames=self.bodies.labelNames, labelIndex=self.bodies.labelIndex, sizes=self.bodies.sizes,
+            masses=self.bodies.masses, initialPositions=self.bodies.positions, initialVelocities=self.bodies.velocities,
+            method=self.method, dt=self.dt, save_every=self.save_every, rtol=self.rtol, atol=self.atol, blockLevels=self.blockLevels, eta=self.eta,
+            bins=getattr(self, 'bins', np.zeros(0, dtype=int)), progress=self.progress,
+            firstTime=self.steps[0], delta=self.steps[1] - self.steps[0] if len(self.steps) > 1 else self.dt, iter=self.iter,
+            position=self.ringPositions[current], velocity=self.ringVelocities[current], acceleration=self.ringAccelerations[current],
+            numForceEvaluations=self.numForceEvaluations, nativeTime=self.nativeTime,
+            precision=self.precision.name, compensated=self.compensated, positionError=self.positionError, velocityError=self.velocityError,
+            collisions=self.collisions or '', restitution=self.restitution, alive=self.alive, aliveMasses=self.masses[:, 0], radii=self.radii,
+            collisionTimes=np.array([event[0] for event in self.collisionEvents], dtype=float),
+            collisionPairs=np.array([event[1:] for event in self.collisionEvents], dtype=int).reshape(-1, 2),
+            storage='' if self.store.directory is None else os.path.abspath(self.store.directory), numSaved=self.store.numSaved,
+        )
+        if self.store.directory is None:
+            for quantity in QUANTITIES:
+                data[quantity] = self.store.data[quantity][:self.store.numSaved]
+        if self.diagnostics is not None:
+            data.update(self.diagnostics.toArrays())
+
+        with open(path + '.tmp', 'wb') as file:
+            np.savez(file, **data)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load_checkpoint(cls, path):
+        """
+        Creates a simulation from a file written by save_checkpoint; it can then be continued with continue_to or extend.
+        With a storage folder, the samples written after the checkpoint stay in the files until the simulation is continued, which replaces them.
+        """
+        data = np.load(path)
+        value = lambda key: data[key].item()
+
+        bodies = BodySet(data['masses'], data['initialPositions'], data['initialVelocities'], data['sizes'], data['labelNames'], data['labelIndex'])
+        scene = cls(bodies, G=value('G'), softening=value('softening'), force_method=value('force_method'), theta=value('theta'), workers=value('workers'),
+                    collisions=value('collisions') or None, restitution=value('restitution'), precision=value('precision'), compensated=value('compensated'))
+
+        scene.method = value('method')
+        scene.integrator = getIntegrator(scene.method)
+        scene.dt, scene.save_every, scene.rtol, scene.atol = value('dt'), value('save_every'), value('rtol'), value('atol')
+        scene.blockLevels, scene.eta, scene.bins, scene.progress = value('blockLevels'), value('eta'), data['bins'], value('progress')
+        scene.checkpoint, scene.checkpoint_every = None, 10000
+        scene.numForceEvaluations, scene.nativeTime = value('numForceEvaluations'), data['nativeTime']
+        scene.alive, scene.masses, scene.radii = data['alive'], data['aliveMasses'][:, np.newaxis], data['radii']
+        scene.collisionEvents = [(time, int(body), int(other)) for time, (body, other) in zip(data['collisionTimes'], data['collisionPairs'])]
+        scene.diagnostics = Diagnostics.fromArrays(data)
+        scene.positionError, scene.velocityError = data['positionError'], data['velocityError']
+
+        scene.iter = value('iter')
+        scene.numSteps = scene.iter + 1
+        scene.steps = value('firstTime') + value('delta') * np.arange(scene.numSteps)
+
+        #Samples stored up to the checkpoint
+        if value('storage'):
+            scene.store = TrajectoryStore.open(value('storage'), mode='r+', numSaved=value('numSaved'))
+        else:
+            scene.store = TrajectoryStore(scene.steps[::scene.save_every], scene.numOfBodies, dtype=scene.precision.storeDtype)
+            for quantity in QUANTITIES:
+                scene.store.data[quantity][:] = data[quantity]
+            scene.store.numSaved = value('numSaved')
+        scene.updateViews()
+
+        scene.ringPositions = np.zeros([RING_SIZE, len(scene.alive), 3], scene.precision.stateDtype)
+        scene.ringVelocities = np.zeros([RING_SIZE, len(scene.alive), 3], scene.precision.stateDtype)
+        scene.ringAccelerations = np.zeros([RING_SIZE, len(scene.alive), 3], scene.precision.stateDtype)
+        current = scene.step()
+        scene.ringPositions[current], scene.ringVelocities[current], scene.ringAccelerations[current] = data['position'], data['velocity'], data['acceleration']
+        return scene
+
+    def step(self, offset = 0):
+        """ Returns the position of the step iter+offset in the ring buffer"""
+        return (self.iter + offset) % RING_SIZE
+
+    def saveStep(self):
+        """ Sends the current step to the store when it is one of the saved steps"""
+        if self.iter % self.save_every == 0:
+            current = self.step()
+            self.store.append(self.expand(self.ringPositions[current]), self.expand(self.ringVelocities[current]), self.expand(self.ringAccelerations[current]))
+
+    def expand(self, values):
+        """ Places the values of the bodies that remain in the rows of all the bodies of the simulation, filling the rows of the removed ones with NaN"""
+        if len(values) == self.numOfBodies:
+            return values
+        expanded = np.full((self.numOfBodies, 3), np.nan)
+        expanded[self.alive] = values
+        return expanded
+
+    def resolveCollisions(self, time):
+        """
+        Finds the bodies that overlap at the current step, with a uniform grid (see collisions.overlappingPairs), and makes them collide.
+        When bodies merge, the arrays of the simulation are compacted to the remaining bodies and their accelerations are recalculated.
+        """
+        current = self.step()
+        positions, velocities = self.ringPositions[current], self.ringVelocities[current]
+        pairs = overlappingPairs(positions, self.radii)
+        if not len(pairs):
+            return
+
+        if self.collisions == 'bounce':
+            self.ringVelocities[current], pairs = bounceBodies(positions, velocities, self.masses[:, 0], pairs, self.restitution)
+            self.velocityError[pairs.ravel()] = 0 #the rounding errors kept by the compensated sums belong to the velocities before the bounce
+            self.collisionEvents += [(time, int(body), int(other)) for body, other in self.alive[pairs]]
+            return
+
+        remaining, merges, positions, velocities, masses, self.radii = mergeBodies(positions, velocities, self.masses[:, 0], self.radii, pairs)
+        self.positionError[pairs.ravel()] = 0 #the merged bodies take new positions and velocities, to which these rounding errors do not belong
+        self.velocityError[pairs.ravel()] = 0
+        self.collisionEvents += [(time, int(body), int(other)) for body, other in self.alive[merges]]
+        self.alive = self.alive[remaining]
+        self.masses = masses[:, np.newaxis]
+        if self.blockLevels:
+            self.bins = self.bins[remaining]
+        self.ringPositions = self.ringPositions[:, remaining]
+        self.ringVelocities = self.ringVelocities[:, remaining]
+        self.ringAccelerations = self.ringAccelerations[:, remaining]
+        self.positionError, self.velocityError = self.positionError[remaining], self.velocityError[remaining]
+        self.ringPositions[current], self.ringVelocities[current] = positions, velocities
+        self.ringAccelerations[current] = self.calculateAccelerations()
+
+    def saveState(self, y, dy):
+        """ Sends a state in the first order form (y = [positions, velocities], dy = [velocities, accelerations]) to the store"""
+        with self.timer.phase('store'):
+            self.store.append(y[0], y[1], dy[1])
+        self.lastState = (y, dy)
+        step = (self.store.numSaved - 1) * self.save_every
+        if self.diagnostics is not None and step % self.diagnostics.every == 0:
+            self.measure(self.time[self.store.numSaved - 1], y[0], y[1])
+
+    def measure(self, time, positions, velocities):
+        """ Records the conserved quantities of a state in the diagnostics, reusing the potential energy of the last force evaluation when it was made at these positions"""
+        with self.timer.phase('diagnostics'):
+            masses = self.masses[:, 0]
+            kinetic = np.sum(masses * np.einsum('ij,ij->i', velocities, velocities)) / 2
+            if self.lastPotential is not None and np.array_equal(self.lastPotential[0], positions):
+                potential = self.lastPotential[1]
+            elif self.force_method == 'barnes_hut':
+                potential = barnesHutAccelerations(positions, self.masses, self.G, self.softening, self.theta, workers=self.workers, potential=True)[1]
+            else:
+                potential = directPotential(positions, self.masses, self.G, self.softening)
+            self.measurePotential = False
+            self.lastPotential = None
+            self.diagnostics.record(time, kinetic=kinetic, potential=potential, energy=kinetic + potential,
+                                    momentum=masses @ velocities, angular_momentum=masses @ np.cross(positions, velocities))
+
+    def advance(self, integrator):
+        """ Calculates the current step from the previous one with a fixed step integrator"""
+        current, previous = self.step(), self.step(-1)
+        x, v, a = self.ringPositions[previous], self.ringVelocities[previous], self.ringAccelerations[previous]
+        if self.compensated:
+            x, v = CompensatedArray(x, self.positionError), CompensatedArray(v, self.velocityError)
+
+        if integrator.kind == 'second_order':
+            x, v, a = integrator.function(self.calculateAccelerations, x, v, a, self.dt)
+        else:
+            stack = CompensatedArray.stack if self.compensated else np.stack
+            y, dy = integrator.function(self.derivs, self.steps[self.iter-1], stack([x, v]), np.stack([v, a]), self.dt)
+            x, v, a = y[0], y[1], dy[1]
+
+        if self.compensated:
+            self.positionError, self.velocityError = x.error, v.error
+            x, v = x.value, v.value
+
         #Calculate and add new properties for each body        
-        self.accelerations[:, :, self.iter] = forces[:] / self.masses[:]
-        self.velocities[:, :, self.iter] = self.velocities[:, :, self.iter-1] + self.accelerations[:, :, self.iter] * self.dt
-        self.positions[:, :, self.iter] = self.positions[:, :, self.iter-1] + self.velocities[:, :, self.iter-1] * self.dt + self.accelerations[:, :, self.iter] * self.dt**2 / 2
+        self.ringPositions[current] = x
+        self.ringVelocities[current] = v
+        self.ringAccelerations[current] = a
 
-    def calculateForces(self):
-        """ Calculate the forces exerted between bodies"""
+    def timeStepBins(self, accelerations, jerks, currentSteps):
+        """ Chooses the level k (time step dt/2**k) of each body from the criterion eta*|acceleration|/|jerk|"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            idealSteps = self.eta * np.linalg.norm(accelerations, axis=1) / np.linalg.norm(jerks, axis=1)
+        idealSteps = np.where(np.isfinite(idealSteps), idealSteps, currentSteps)
+        with np.errstate(divide='ignore'):
+            levels = np.ceil(np.log2(self.dt / idealSteps))
+        return np.clip(levels, 0, self.blockLevels).astype(int)
 
-        bodiesIndexes = range(self.numOfBodies)
-        bodyInteractions = list(product(bodiesIndexes,bodiesIndexes)) #lista com todas as interações entre corpos
-        
-        forcesMatrix = np.zeros((self.numOfBodies,self.numOfBodies,3)) #matriz de forças (corpo_i, corpo_j, coordenada)
+    def advanceBlocks(self):
+        """
+        Calculates the current step from the previous one with hierarchical block time steps: the interval dt is divided in 2**blockLevels substeps,
+        all bodies drift every substep and only the bodies that reach the end of their own step have their accelerations recalculated (kick-drift-kick leapfrog).
+        """
+        current, previous = self.step(), self.step(-1)
+        x = self.ringPositions[previous].copy()
+        v = self.ringVelocities[previous].copy()
+        a = self.ringAccelerations[previous].copy()
+        numSubsteps = 2**self.blockLevels
+        h = self.dt / numSubsteps
 
-        for interaction in bodyInteractions:
-            i, j = interaction
-            
-            if i < j:
-                r = self.positions[j, :, self.iter-1] - self.positions[i, :, self.iter-1] #Vetor distância
-                rNorm = np.linalg.norm(r)  #Norma do vetor distância
+        for substep in range(numSubsteps):
+            stride = 2**(self.blockLevels - self.bins) #number of substeps of the step of each body
+            steps = stride * h
 
-                force = -self.G * self.masses[i,0] * self.masses[j,0] / rNorm**2 * r/rNorm #Força entre os cors i e j
+            starting = substep % stride == 0
+            v[starting] += a[starting] * steps[starting, np.newaxis] / 2
+            x += v * h
 
-                forcesMatrix[i,j,:] = -force
-                forcesMatrix[j,i,:] = force
+            active = np.flatnonzero((substep + 1) % stride == 0)
+            if not len(active):
+                continue
+            aNew = self.calculateAccelerations(x, active)
+            v[active] += aNew * steps[active, np.newaxis] / 2
+            jerks = (aNew - a[active]) / steps[active, np.newaxis]
+            a[active] = aNew
 
-        return np.sum(forcesMatrix, axis=1) #retorna um array com as forças resultantes
+            #Bodies may always move to a smaller step, but only to a larger one that is synchronized with the current substep
+            levels = self.timeStepBins(aNew, jerks, steps[active])
+            synchronized = (substep + 1) & -(substep + 1)
+            lowestLevel = max(0, self.blockLevels - int(np.log2(synchronized)))
+            self.bins[active] = np.where(levels < self.bins[active], np.maximum(levels, lowestLevel), levels)
 
-    def verlet(self):
-        """ Calculate new positions using the verlet integration method"""
-        forces = self.calculateForces()
+        self.ringPositions[current] = x
+        self.ringVelocities[current] = v
+        self.ringAccelerations[current] = a
 
-        #Calculates and adds new properties for each body
-        self.accelerations[:, :, self.iter] = forces[:] / self.masses[:]
-        self.positions[:, :, self.iter] = self.accelerations[:, :, self.iter] * self.dt**2 - self.positions[:, :, self.iter-2] + 2 * self.positions[:, :, self.iter-1]
-        self.velocities[:, :, self.iter] = self.velocities[:, :, self.iter] + self.accelerations[:, :, self.iter] * self.dt
+    def derivs(self, t, y):
+        """ Time derivative of the state in the first order form y = [positions, velocities]"""
+        return np.stack([y[1], self.calculateAccelerations(y[0])])
 
-    def showScene(self, dtStepPerFrame = 1):
+    def calculateAccelerations(self, positions = None, targets = None):
+        """
+        Calculate the accelerations of the bodies at the given positions (by default, the ones of the current step).
+        When targets (indexes of bodies) are given, only their accelerations are calculated, and numForceEvaluations grows by the fraction of the bodies evaluated.
+        """
+        if positions is None:
+            positions = self.ringPositions[self.step()]
+        state = positions
+        #no copy when the types already match, as with the "double" precision
+        positions = np.asarray(positions, dtype=self.precision.forceDtype)
+        masses = self.masses.astype(self.precision.forceDtype, copy=False)
+        self.numForceEvaluations += 1 if targets is None else len(targets) / len(self.masses)
+        with self.timer.phase('force'):
+            if self.force_method == 'barnes_hut':
+                kernel = lambda **args: barnesHutAccelerations(positions, masses, self.G, self.softening, self.theta, workers=self.workers, **args)
+            else:
+                kernel = lambda **args: directAccelerations(positions, masses, self.G, self.softening, workers=self.workers, **args)
+            if self.measurePotential and targets is None:
+                accelerations, potential = kernel(potential=True)
+                self.lastPotential = (np.array(state), potential)
+                return accelerations
+            return kernel(targets=targets)
+
+    def calculateForces(self):
+        """ Calculate the resulting forces exerted on each body"""
+        return self.calculateAccelerations() * self.masses #retorna um array com as forças resultantes
+
+    def energy(self, sample = -1):
+        """ Total energy (kinetic + potential) of the system at one of the stored samples"""
+        masses = self.massesAt(sample)
+        present = ~np.isnan(self.positions[:, 0, sample])
+        velocities = self.velocities[present, :, sample]
+        kinetic = np.sum(masses[present] * np.einsum('ij,ij->i', velocities, velocities)) / 2
+        return kinetic + directPotential(self.positions[present, :, sample], masses[present], self.G, self.softening)
+
+    def massesAt(self, sample = -1):
+        """ Masses of all bodies at one of the stored samples, after the merges up to it (the bodies already absorbed have no mass)"""
+        masses = self.bodies.masses.copy()
+        if self.collisions == 'merge':
+            for time, body, other in self.collisionEvents:
+                if time > self.time[sample]:
+                    break
+                masses[body] += masses[other]
+                masses[other] = 0
+        return masses
+
+    def showScene(self, dtStepPerFrame = 1, trail_length = 0):
         """
         Uses the external show() function to plot the simulation animation
 
          It can receive the following variable as input:
              dtStepPerFrame: The value that will correspond to the number of steps that will be skipped for each frame of the simulation
                  int
+             trail_length: Duration of the fading orbit trail drawn behind each body (no trails when 0)
+                 float
+        """
+        from display import show
+        show(self, dtStepPerFrame, trail_length=trail_length)
+
+    def export_video(self, path, fps = 30, dtStepPerFrame = 1, trail_length = 0, resolution = None, workers = 1, codec = 'libx264'):
+        """
+        Renders the animation without opening a window (Agg backend) and streams the frames to ffmpeg, which must be installed, to encode a video file.
+
+        It can receive the following variables as input:
+            path: Video file that will be written; its extension selects the container (e.g. ".mp4")
+                str
+            fps: Frames per second of the video
+                int
+            dtStepPerFrame: Number of stored samples skipped for each frame, as in showScene
+                int
+            trail_length: Duration of the fading orbit trail drawn behind each body (no trails when 0)
+                float
+            resolution: Width and height of the video in pixels; by default, display.RESOLUTION (1920x1080)
+                (int, int)
+            workers: Number of processes; each one renders and encodes a contiguous range of frames, and the parts are joined at the end
+                int
+            codec: Video encoder used by ffmpeg
+                str
+        """
+        from display import exportVideo, RESOLUTION
+        exportVideo(self, path, fps, dtStepPerFrame, workers, codec, resolution=resolution or RESOLUTION, trail_length=trail_length)
+
+    def export_frames(self, directory, dtStepPerFrame = 1, trail_length = 0, resolution = None, workers = 1):
+        """ Renders the animation without opening a window and writes each frame as a numbered PNG file to the directory (see export_video for the other arguments)"""
+        from display import exportFrames, RESOLUTION
+        exportFrames(self, directory, dtStepPerFrame, workers, resolution=resolution or RESOLUTION, trail_length=trail_length)
+
+    def checkQuantities(self, quantities):
+        for quantity in quantities:
+            if quantity not in QUANTITIES:
+                raise ValueError(f'Unknown quantity "{quantity}", use one of: {", ".join(QUANTITIES)}')
+
+    def exportDF(self, quantities = ('positions',), stride = 1, layout = 'wide'):
+        """
+        Export the calculated data in the format of a pandas dataframe
+
+         It can receive the following variables as input:
+             quantities: Stored quantities that will be exported ("positions", "velocities", "accelerations")
+                 tuple of str
+             stride: Only one of every stride samples is exported
+                 int
+             layout: "wide", with the time and one column per body, coordinate and quantity (e.g. "body-0 X position"), built from a single block of memory;
+                 or "long", with one row per sample and body (columns time, body, positions_x, ...)
+                 str
         """
-        show(self, dtStepPerFrame)
+        if layout not in DF_LAYOUTS:
+            raise ValueError(f'Unknown layout "{layout}", use one of: {", ".join(DF_LAYOUTS)}')
+        import pandas as pd
+
+        self.checkQuantities(quantities)
+        samples = slice(None, None, stride)
+        with self.timer.phase('export'):
+            if layout == 'long':
+                return pd.DataFrame(longColumns(self.time, {quantity: self.store.data[quantity] for quantity in quantities}, ('x', 'y', 'z'), samples))
+
+            time = self.time[samples]
+            width = 3 * self.numOfBodies
+            data = np.empty((len(time), 1 + width * len(quantities)))
+            data[:, 0] = time
+            columns = ['time']
+            for index, quantity in enumerate(quantities):
+                data[:, 1 + index * width:1 + (index + 1) * width] = self.store.data[quantity][samples].reshape(len(time), width)
+                columns += [f'body-{bodyIndex} {coordinate} {COLUMN_NAMES[quantity]}' for bodyIndex in range(self.numOfBodies) for coordinate in 'XYZ']
+            return pd.DataFrame(data, columns=columns, copy=False)
 
-    def exportDF(self):
-        """ Export all calculated data in the format of a pandas dataframe"""
-        dfDict = {}
+    def export(self, path, quantities = ('positions',), layout = 'long', format = None, stride = 1):
+        """
+        Writes the stored samples to a file straight from the simulation arrays (which may be on disk), without creating a dataframe
 
-        dfDict['time'] = self.time
+         It can receive the following variables as input:
+             path: ".parquet" file (needs pyarrow), ".npz" file, or folder where one .npy file is written per column (long layout) or quantity (tensor layout)
+                 str
+             quantities: Stored quantities that will be exported ("positions", "velocities", "accelerations")
+                 tuple of str
+             layout: "long", with one row per sample and body (columns time, body, positions_x, ...), or "tensor", with one [sample, body, coordinate] array per quantity
+                 str
+             format: "parquet", "npz" or "npy"; when not provided, it is given by the extension of the path
+                 str
+             stride: Only one of every stride samples is exported
+                 int
+        """
+        self.checkQuantities(quantities)
+        self.store.flush()
+        with self.timer.phase('export'):
+            exportTrajectories(path, self.time, {quantity: self.store.data[quantity] for quantity in quantities}, labelNames=self.bodies.labelNames,
+                               labelIndex=self.bodies.labelIndex, layout=layout, format=format, stride=stride)
 
-        for bodyIndex in range(self.numOfBodies):
-            dfDict[f'body-{bodyIndex} X position'] = self.positions[bodyIndex, 0, :]
-            dfDict[f'body-{bodyIndex} Y position'] = self.positions[bodyIndex, 1, :]
-            dfDict[f'body-{bodyIndex} Z position'] = self.positions[bodyIndex, 2, :]
+    def enable_timing(self):
+        """
+        Starts measuring the time spent in each phase of the simulation ("force", "integrate", "collisions", "store", "diagnostics", "checkpoint", "export", "render_frame")
+        and returns the PhaseTimer, whose report() gives the totals; the timing is disabled again with disable_timing()
+        """
+        self.timer = PhaseTimer()
+        return self.timer
 
-        return pd.DataFrame(dfDict)
+    def disable_timing(self):
+        self.timer = NULL_TIMER
 
 if __name__ == "__main__":
     from body import CreateBodyGrav
@@ -0,0 +1,156 @@
+import numpy as np
+
+#Registry with every integration method available to the simulations, by name
+INTEGRATORS = {}
+
+class Integrator():
+    """
+    Describes one integration method of the registry.
+        - name: name used to select the method in the simulations
+            str
+        - function: function that performs the integration; its signature depends on the kind of method:
+            "second_order": step(accelerations, x, v, a, dt) -> (x, v, a), for systems whose acceleration depends only on the positions (a = accelerations(x))
+            "first_order": step(derivs, t, y, dy, dt) -> (y, dy), for any system dy/dt = derivs(t, y)
+            adaptive methods: integrate(derivs, t0, y0, dy0, outputTimes, dt, emit, rtol, atol) -> times of the accepted steps, calling emit(y, dy) at each of the outputTimes
+        - kind: "first_order" or "second_order"
+            str
+        - adaptive: whether the method chooses its own step size
+            bool
+
+    Every function receives and returns the derivative (or acceleration) at the current state, so it is evaluated only once per step.
+    """
+
+    def __init__(self, name, function, kind, adaptive = False):
+        self.name = name
+        self.function = function
+        self.kind = kind
+        self.adaptive = adaptive
+
+def register(name, kind, adaptive = False):
+    """ Decorator that adds a function to the registry of integrators under the given name"""
+    def decorator(function):
+        INTEGRATORS[name] = Integrator(name, function, kind, adaptive)
+        return function
+    return decorator
+
+def getIntegrator(name, kinds = ('first_order', 'second_order')):
+    """ Returns the integrator registered under the given name, checking that it is of one of the accepted kinds"""
+    available = [key for key, integrator in INTEGRATORS.items() if integrator.kind in kinds]
+    if name not in available:
+        raise ValueError(f'Unknown method "{name}", use one of: {", ".join(available)}')
+    return INTEGRATORS[name]
+
+@register('eqMov', 'second_order')
+def movementEq(accelerations, x, v, a, dt):
+    """ Equations of motion with constant acceleration during the step (first order)"""
+    xNew = x + v * dt + a * dt**2 / 2
+    return xNew, v + a * dt, accelerations(xNew)
+
+@register('verlet', 'second_order')
+@register('leapfrog', 'second_order')
+def verlet(accelerations, x, v, a, dt):
+    """ Velocity Verlet integration, equivalent to the kick-drift-kick leapfrog (second order, symplectic)"""
+    vHalf = v + a * dt / 2
+    xNew = x + vHalf * dt
+    aNew = accelerations(xNew)
+    return xNew, vHalf + aNew * dt / 2, aNew
+
+#Coefficients of the fourth order composition of Yoshida (1990)
+YOSHIDA_W1 = 1 / (2 - 2**(1/3))
+YOSHIDA_W0 = -2**(1/3) * YOSHIDA_W1
+
+@register('yoshida4', 'second_order')
+def yoshida4(accelerations, x, v, a, dt):
+    """ Yoshida composition of three leapfrog steps (fourth order, symplectic)"""
+    for weight in (YOSHIDA_W1, YOSHIDA_W0, YOSHIDA_W1):
+        x, v, a = verlet(accelerations, x, v, a, weight * dt)
+    return x, v, a
+
+@register('euler', 'first_order')
+def euler(derivs, t, y, dy, dt):
+    """ Explicit Euler method (first order)"""
+    yNew = y + dy * dt
+    return yNew, derivs(t + dt, yNew)
+
+@register('rk4', 'first_order')
+def rk4(derivs, t, y, dy, dt):
+    """ Classical Runge-Kutta method (fourth order)"""
+    k2 = derivs(t + dt/2, y + dy * dt/2)
+    k3 = derivs(t + dt/2, y + k2 * dt/2)
+    k4 = derivs(t + dt, y + k3 * dt)
+    yNew = y + (dy + 2*k2 + 2*k3 + k4) * dt/6
+    return yNew, derivs(t + dt, yNew)
+
+#Butcher tableau of the Dormand-Prince 5(4) method
+DP_C = (0, 1/5, 3/10, 4/5, 8/9, 1, 1)
+DP_A = ((),
+        (1/5,),
+        (3/40, 9/40),
+        (44/45, -56/15, 32/9),
+        (19372/6561, -25360/2187, 64448/6561, -212/729),
+        (9017/3168, -355/33, 46732/5247, 49/176, -5103/18656),
+        (35/384, 0, 500/1113, 125/192, -2187/6784, 11/84))
+#Difference between the fifth and fourth order weights, used as error estimate
+DP_E = (71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40)
+
+#Smallest step of the adaptive method, as a fraction of the integrated interval; below it the run stops instead of shrinking the step forever
+MIN_STEP_FRACTION = 1e-12
+
+def hermite(s, h, y0, dy0, y1, dy1):
+    """ Cubic Hermite interpolation (value and derivative) at the fraction s of a step of size h"""
+    s2, s3 = s*s, s*s*s
+    y = (2*s3 - 3*s2 + 1) * y0 + (s3 - 2*s2 + s) * h * dy0 + (-2*s3 + 3*s2) * y1 + (s3 - s2) * h * dy1
+    dy = ((6*s2 - 6*s) * (y0 - y1)) / h + (3*s2 - 4*s + 1) * dy0 + (3*s2 - 2*s) * dy1
+    return y, dy
+
+@register('rk45', 'first_order', adaptive = True)
+def rk45(derivs, t0, y0, dy0, outputTimes, dt, emit, rtol = 1e-8, atol = 1e-10):
+    """
+    Dormand-Prince 5(4) method with adaptive step size. The step is chosen so that the estimated local error stays below atol + rtol*|y|,
+    and the solution is interpolated at each of the outputTimes (dense output with cubic Hermite polynomials).
+    dt is used as the size of the first step. A step whose error estimate is not finite (e.g. bodies at the same position without softening) is rejected and halved;
+    when the step falls below MIN_STEP_FRACTION of the interval, a RuntimeError is raised.
+    """
+    t, y, dy = t0, y0, dy0
+    h = dt
+    tEnd = outputTimes[-1]
+    minStep = MIN_STEP_FRACTION * max(abs(tEnd - t0), abs(dt))
+    out = 0
+    while out < len(outputTimes) and outputTimes[out] <= t:
+        emit(y, dy)
+        out += 1
+    nativeTimes = [t]
+
+    while out < len(outputTimes):
+        last = h >= tEnd - t
+        if last:
+            h = tEnd - t
+
+        k = [dy]
+        for stage in range(1, 6):
+            k.append(derivs(t + DP_C[stage] * h, y + h * sum(coef * kj for coef, kj in zip(DP_A[stage], k) if coef)))
+        yNew = y + h * sum(coef * kj for coef, kj in zip(DP_A[6], k) if coef)
+        dyNew = derivs(t + h, yNew)
+        k.append(dyNew)
+
+        error = h * sum(coef * kj for coef, kj in zip(DP_E, k) if coef)
+        scale = atol + rtol * np.maximum(np.abs(y), np.abs(yNew))
+        errorNorm = np.max(np.abs(error) / scale)
+
+        if not np.isfinite(errorNorm):
+            h /= 2
+        elif errorNorm <= 1:
+            tNew = tEnd if last else t + h
+            while out < len(outputTimes) and outputTimes[out] <= tNew:
+                yOut, dyOut = hermite((outputTimes[out] - t) / h, h, y, dy, yNew, dyNew)
+                emit(yOut, dyOut)
+                out += 1
+            t, y, dy = tNew, yNew, dyNew
+            nativeTimes.append(t)
+
+        if np.isfinite(errorNorm):
+            h *= min(5, max(0.2, 0.9 * errorNorm**-0.2)) if errorNorm > 0 else 5
+        if h < minStep and out < len(outputTimes):
+            raise RuntimeError(f'The step size of the adaptive method fell below {minStep:.3e} at t = {t}; the solution may be singular (e.g. bodies at the same position without softening)')
+
+    return np.array(nativeTimes)
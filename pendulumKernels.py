@@ -0,0 +1,69 @@
+import math
+import importlib.util
+from functools import lru_cache
+
+#Numba is optional: when it is not installed the simulation falls back to the NumPy implementation of PendulumSim.
+#It is imported only when the loops are first compiled, since importing it takes longer than the short runs of the sweeps
+HAS_NUMBA = importlib.util.find_spec('numba') is not None
+
+def pendulumDerivs(th1, w1, th2, w2, M1, M2, L1, L2, G):
+    """ Scalar version of PendulumSim.derivs: returns the time derivatives of (theta1, w1, theta2, w2)"""
+    delta = th2 - th1
+    sinDelta = math.sin(delta)
+    cosDelta = math.cos(delta)
+    sin1 = math.sin(th1)
+    sin2 = math.sin(th2)
+
+    den1 = (M1+M2) * L1 - M2 * L1 * cosDelta * cosDelta
+    dw1 = ((M2 * L1 * w1 * w1 * sinDelta * cosDelta
+            + M2 * G * sin2 * cosDelta
+            + M2 * L2 * w2 * w2 * sinDelta
+            - (M1+M2) * G * sin1)
+           / den1)
+
+    den2 = (L2/L1) * den1
+    dw2 = ((- M2 * L2 * w2 * w2 * sinDelta * cosDelta
+            + (M1+M2) * G * sin1 * cosDelta
+            - (M1+M2) * L1 * w1 * w1 * sinDelta
+            - (M1+M2) * G * sin2)
+           / den2)
+
+    return w1, dw1, w2, dw2
+
+def eulerLoop(y, dt, M1, M2, L1, L2, G):
+    """ Integrates in place the [numIterations, 4] state array y, whose first row holds the initial state, with Euler's method"""
+    for i in range(1, y.shape[0]):
+        d0, d1, d2, d3 = pendulumDerivs(y[i-1, 0], y[i-1, 1], y[i-1, 2], y[i-1, 3], M1, M2, L1, L2, G)
+        y[i, 0] = y[i-1, 0] + d0 * dt
+        y[i, 1] = y[i-1, 1] + d1 * dt
+        y[i, 2] = y[i-1, 2] + d2 * dt
+        y[i, 3] = y[i-1, 3] + d3 * dt
+
+def ensembleEulerLoop(state, time, dt, M1, M2, L1, L2, G, flipTime):
+    """
+    Integrates in place, with Euler's method, the [numOfPendulums, 4] state array of an ensemble, keeping only the final state.
+    flipTime receives the first time at which |theta1| or |theta2| exceeds pi (it must be initialized with NaN).
+    """
+    for n in range(state.shape[0]):
+        th1, w1, th2, w2 = state[n, 0], state[n, 1], state[n, 2], state[n, 3]
+        flipped = not math.isnan(flipTime[n])
+        for i in range(1, time.shape[0]):
+            d0, d1, d2, d3 = pendulumDerivs(th1, w1, th2, w2, M1[n], M2[n], L1[n], L2[n], G)
+            th1 += d0 * dt
+            w1 += d1 * dt
+            th2 += d2 * dt
+            w2 += d3 * dt
+            if not flipped and (abs(th1) > math.pi or abs(th2) > math.pi):
+                flipTime[n] = time[i]
+                flipped = True
+        state[n, 0], state[n, 1], state[n, 2], state[n, 3] = th1, w1, th2, w2
+
+@lru_cache(maxsize=None)
+def numbaKernels():
+    """ Returns eulerLoop and ensembleEulerLoop compiled by Numba, importing it on the first call"""
+    global pendulumDerivs
+    from numba import njit
+
+    #Each time loop is compiled into a single kernel (pendulumDerivs is inlined by the compiler, which reads it from the globals of the module)
+    pendulumDerivs = njit(cache=True)(pendulumDerivs)
+    return njit(cache=True)(eulerLoop), njit(cache=True)(ensembleEulerLoop)
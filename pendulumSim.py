@@ -1,14 +1,28 @@
-import matplotlib.pyplot as plt
+import os
 import numpy as np
 from numpy import cos, sin
-
-import matplotlib.animation as animation
-
-import pandas as pd
-from itertools import product
-from tqdm import tqdm
 from body import CreateBodyPen
-from display import show
+from pendulumKernels import HAS_NUMBA, numbaKernels
+from integrators import getIntegrator
+from columnar import exportTrajectories
+from diagnostics import Diagnostics
+from profiling import PhaseTimer, NULL_TIMER
+#the display module (matplotlib) is imported only by the methods that use it, and Numba only when the first loop is compiled
+
+#Number of pendulums of an ensemble integrated together by the NumPy backend (keeps the temporaries in cache)
+ENSEMBLE_CHUNK = 65536
+
+def selectBackend(backend, method):
+    """ Resolves the "auto" backend and checks that the requested backend can run the integration method"""
+    if backend == 'auto':
+        backend = 'numba' if HAS_NUMBA and method == 'euler' else 'numpy'
+    if backend not in ('numba', 'numpy'):
+        raise ValueError(f'Unknown backend "{backend}", use "auto", "numba" or "numpy"')
+    if backend == 'numba' and not HAS_NUMBA:
+        raise ImportError('The "numba" backend requires the numba package')
+    if backend == 'numba' and method != 'euler':
+        raise ValueError('The "numba" backend only supports the "euler" method')
+    return backend
 
 
 class PendulumSim():
@@ -36,9 +50,32 @@ class PendulumSim():
 
         self.L = self.L1 + self.L2
         self.origin = origin
+        self.diagnostics = None
+        self.timer = NULL_TIMER
 
 
-    def simulate(self, timeInterval, dt = 0.01):
+    def simulate(self, timeInterval, dt = 0.01, backend = 'auto', method = 'euler', rtol = 1e-8, atol = 1e-10, diagnostics_every = 0, drift_threshold = None):
+        """
+        Integrates the movement of the pendulum within a given time range.
+
+        Takes the following variables as input:
+            - timeInterval: A list containing the initial and final time for which the simulation will be conducted
+                [initial_time, final_time]
+            - dt: Time step to be used during the process (for the adaptive methods, the size of the first step)
+                numerical value as int or float
+            - backend: Corresponds to the implementation of the integration loop; it can be one of the following:
+                "auto": uses "numba" when it is installed and the method is "euler", and "numpy" otherwise
+                "numba": compiles the derivatives and the whole time loop with Numba (only for the "euler" method)
+                "numpy": integrates step by step in Python with the derivs method
+            - method: Any first order method of the integrators registry ("euler", "rk4" or the adaptive "rk45", whose solution is interpolated at the requested time steps)
+                str
+            - rtol, atol: Relative and absolute tolerances of the local error, used only by the adaptive methods
+                numerical value as int or float
+            - diagnostics_every: When greater than zero, the kinetic, potential and total energies are recorded every diagnostics_every steps in self.diagnostics
+                int
+            - drift_threshold: Largest relative energy drift accepted by the diagnostics; when it is exceeded, the run stops with a DriftError (the steps after it are NaN)
+                numerical value as int or float
+        """
 
     # create a time array from 0..t_stop sampled at 0.02 second steps
         self.dt = dt
@@ -47,26 +84,79 @@ class PendulumSim():
         # th1 and th2 are the initial angles (degrees)
         # w10 and w20 are the initial angular velocities (degrees per second)
 
-
-        time_list = []
+        self.method = method
+        self.integrator = getIntegrator(method, kinds=('first_order',))
+        self.backend = selectBackend(backend, method)
+        self.rtol = rtol
+        self.atol = atol
+        self.diagnostics = Diagnostics(diagnostics_every, drift_threshold) if diagnostics_every else None
 
     # initial state
         state = np.radians([self.th1, self.w1, self.th2, self.w2])
 
 
-    # integrate the ODE using Euler's method
-        y = np.empty((len(self.time), 4))
+    # integrate the ODE
+        y = np.full((len(self.time), 4), np.nan)
         
         y[0] = state
-        for i in range(1, len(self.time)):
-
-            y[i] = y[i - 1] + self.derivs(self.time[i - 1], y[i - 1]) * dt
-            time_list.append(self.time[i - 1])
-
-
-        time_list.append(self.time[-1])
-
-        time_array = np.array(time_list)
+        self.y = y
+        self.nativeTime = self.time[:1]
+        self.measure(self.time[0], state, 0)
+        try:
+            with self.timer.phase('integrate'):
+                self.nativeTime = self.integrate(y, self.time)
+        finally:
+            with self.timer.phase('positions'):
+                self.updatePositions()
+
+    def integrate(self, y, time, offset = 0):
+        """
+        Fills the rows of the state array y from its first one (the state at time[0]) over the given time steps, and returns the times of the steps of adaptive methods.
+        offset is the number of the step of the first row in the whole simulation, used to choose the steps recorded by the diagnostics.
+        """
+        derivs = self.derivs if self.timer is NULL_TIMER else self.timedDerivs
+        if self.backend == 'numba':
+            eulerLoop, _ = numbaKernels()
+            if self.diagnostics is None:
+                eulerLoop(y, self.dt, self.M1, self.M2, self.L1, self.L2, self.G)
+            else:
+                #the compiled loop runs up to each recorded step, so the drift is checked during the run
+                start = 0
+                while start < len(time) - 1:
+                    stop = min(len(time) - 1, start + self.diagnostics.every - (offset + start) % self.diagnostics.every)
+                    eulerLoop(y[start:stop + 1], self.dt, self.M1, self.M2, self.L1, self.L2, self.G)
+                    self.measure(time[stop], y[stop], offset + stop)
+                    start = stop
+        elif self.integrator.adaptive:
+            rows = iter(range(len(time)))
+            def emit(state, dstate):
+                row = next(rows)
+                y[row] = state
+                if row:
+                    self.measure(time[row], state, offset + row)
+            return self.integrator.function(derivs, time[0], y[0].copy(), derivs(time[0], y[0]), time, self.dt, emit, self.rtol, self.atol)
+        else:
+            dstate = derivs(time[0], y[0])
+            for i in range(1, len(time)):
+                y[i], dstate = self.integrator.function(derivs, time[i - 1], y[i - 1], dstate, self.dt)
+                self.measure(time[i], y[i], offset + i)
+        return time[:1]
+
+    def timedDerivs(self, t, state):
+        """ derivs, with its time added to the "derivs" phase of the timer"""
+        with self.timer.phase('derivs'):
+            return self.derivs(t, state)
+
+    def measure(self, time, state, step):
+        """ Records the energies of a state in the diagnostics when the step is one of the recorded steps"""
+        if self.diagnostics is not None and step % self.diagnostics.every == 0:
+            with self.timer.phase('diagnostics'):
+                kinetic, potential = self.stateEnergy(state)
+                self.diagnostics.record(time, kinetic=kinetic, potential=potential, energy=kinetic + potential)
+
+    def updatePositions(self):
+        """ Calculates the cartesian positions of the bodies from the angles"""
+        y = self.y
 
         x1 = self.L1*sin(y[:, 0])
         y1 = -self.L1*cos(y[:, 0])
@@ -79,14 +169,73 @@ class PendulumSim():
         self.body1_array = np.array(body1)
         self.body2_array = np.array(body2)
 
+    def continue_to(self, finalTime):
+        """ Continues the last simulation, with the same settings, from its last step up to finalTime, appending the new steps to y, time and the body arrays"""
+        delta = self.time[1] - self.time[0] if len(self.time) > 1 else self.dt
+        numSteps = int(np.floor((finalTime - self.time[0]) / delta + 1e-9)) + 1
+        if numSteps <= len(self.time):
+            raise ValueError(f'The simulation has already reached t = {self.time[-1]}')
+
+        #Same values that np.arange would give for the whole interval
+        newTime = self.time[0] + delta * np.arange(len(self.time), numSteps)
+        segment = np.full((len(newTime) + 1, 4), np.nan)
+        segment[0] = self.y[-1]
+        nativeTime = self.time[-1:]
+        try:
+            with self.timer.phase('integrate'):
+                nativeTime = self.integrate(segment, np.concatenate([self.time[-1:], newTime]), len(self.time) - 1)
+        finally:
+            self.nativeTime = np.concatenate([self.nativeTime, nativeTime[1:]])
+            self.time = np.concatenate([self.time, newTime])
+            self.numIterations = len(self.time)
+            self.y = np.concatenate([self.y, segment[1:]])
+            with self.timer.phase('positions'):
+                self.updatePositions()
+
+    def extend(self, duration):
+        """ Continues the last simulation for more duration units of time (see continue_to)"""
+        self.continue_to(self.time[-1] + duration)
+
+    def save_checkpoint(self, path):
+        """ Saves, in a single .npz file, the bodies, the settings and the integrated states, so the simulation can be continued later (see GravitySim.save_checkpoint)"""
+        with open(path + '.tmp', 'wb') as file:
+            np.savez(file, masses=[self.M1, self.M2], w=[self.w1, self.w2], lengths=[self.L1, self.L2], thetas=[self.th1, self.th2],
+                     sizes=np.array([body.size for body in self.bodies], dtype=float), labels=np.array([body.label for body in self.bodies]),
+                     G=self.G, origin=self.origin, method=self.method, backend=self.backend, rtol=self.rtol, atol=self.atol, dt=self.dt,
+                     time=self.time, y=self.y, nativeTime=self.nativeTime, **({} if self.diagnostics is None else self.diagnostics.toArrays()))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load_checkpoint(cls, path):
+        """ Creates a simulation from a file written by save_checkpoint; it can then be continued with continue_to or extend"""
+        data = np.load(path)
+        value = lambda key: data[key].item()
+
+        bodies = [CreateBodyPen(mass, w, length, theta, size, str(label)) for mass, w, length, theta, size, label in
+                  zip(data['masses'], data['w'], data['lengths'], data['thetas'], data['sizes'], data['labels'])]
+        scene = cls(bodies[0], bodies[1], G=value('G'), origin=list(data['origin']))
+
+        scene.method, scene.backend = value('method'), value('backend')
+        scene.integrator = getIntegrator(scene.method, kinds=('first_order',))
+        scene.rtol, scene.atol, scene.dt = value('rtol'), value('atol'), value('dt')
+        scene.time, scene.y, scene.nativeTime = data['time'], data['y'], data['nativeTime']
+        scene.numIterations = len(scene.time)
+        scene.diagnostics = Diagnostics.fromArrays(data)
+        scene.updatePositions()
+        return scene
+
+    def energy(self, sample = -1):
+        """ Total energy (kinetic + potential) of the pendulum at one of the integrated steps"""
+        return sum(self.stateEnergy(self.y[sample]))
+
+    def stateEnergy(self, state):
+        """ Kinetic and potential energies of the pendulum in a state (theta1, w1, theta2, w2)"""
+        th1, w1, th2, w2 = state
+        kinetic = ((self.M1+self.M2) * self.L1**2 * w1**2 / 2 + self.M2 * self.L2**2 * w2**2 / 2
+                   + self.M2 * self.L1 * self.L2 * w1 * w2 * cos(th1 - th2))
+        potential = - (self.M1+self.M2) * self.G * self.L1 * cos(th1) - self.M2 * self.G * self.L2 * cos(th2)
+        return kinetic, potential
 
-        #print('body1', body1)
-        #print('body2', body2)
-        #print('time array', time_array)
-
-        
-        
-    
     def derivs(self, t, state):
         dydx = np.zeros_like(state)
 
@@ -111,26 +260,186 @@ class PendulumSim():
 
         return dydx
     
-    def showScene(self, dtStepPerFrame = 1, use_lines = False):
+    def showScene(self, dtStepPerFrame = 1, use_lines = False, trail_length = 0):
         """
         Utiliza a função externa show() para realizar o plot da animação da simulação
 
         Pode receber como entrada a seguinte variável:
             dtStepPerFrame: O valor que corresponderá à quantidade de passos que será pulada para cada frame da simulação
                 int
+            trail_length: Duração do rastro que é desenhado atrás de cada corpo (sem rastro quando 0)
+                float
         """
+        self.scenePositions()
+        from display import show
+        show(self, dtStepPerFrame, use_lines, trail_length=trail_length)
+
+    def export_video(self, path, fps = 30, dtStepPerFrame = 1, use_lines = False, trail_length = 0, resolution = None, workers = 1, codec = 'libx264'):
+        """
+        Renders the animation without opening a window (Agg backend) and streams the frames to ffmpeg, which must be installed, to encode a video file.
+
+        It can receive the following variables as input:
+            path: Video file that will be written; its extension selects the container (e.g. ".mp4")
+                str
+            fps: Frames per second of the video
+                int
+            dtStepPerFrame: Number of stored samples skipped for each frame, as in showScene
+                int
+            use_lines: Whether the lines of the pendulum are drawn
+                bool
+            trail_length: Duration of the fading orbit trail drawn behind each body (no trails when 0)
+                float
+            resolution: Width and height of the video in pixels
+                (int, int)
+            workers: Number of processes; each one renders and encodes a contiguous range of frames, and the parts are joined at the end
+                int
+            codec: Video encoder used by ffmpeg
+                str
+        """
+        self.scenePositions()
+        from display import exportVideo, RESOLUTION
+        exportVideo(self, path, fps, dtStepPerFrame, workers, codec, resolution=resolution or RESOLUTION, use_lines=use_lines, trail_length=trail_length)
+
+    def export_frames(self, directory, dtStepPerFrame = 1, use_lines = False, trail_length = 0, resolution = None, workers = 1):
+        """ Renders the animation without opening a window and writes each frame as a numbered PNG file to the directory (see export_video for the other arguments)"""
+        self.scenePositions()
+        from display import exportFrames, RESOLUTION
+        exportFrames(self, directory, dtStepPerFrame, workers, resolution=resolution or RESOLUTION, use_lines=use_lines, trail_length=trail_length)
+
+    def export(self, path, layout = 'long', format = None, stride = 1):
+        """
+        Writes the cartesian positions of the bodies (body1_array and body2_array) to a file, with the same layouts and formats as GravitySim.export.
+        The quantity is named "positions", with the coordinates x and y.
+        """
+        with self.timer.phase('export'):
+            positions = np.stack([self.body1_array.T, self.body2_array.T], axis=1)
+            exportTrajectories(path, self.time, {'positions': positions}, coordinates=('x', 'y'), labelNames=[body.label for body in self.bodies],
+                               labelIndex=np.arange(len(self.bodies)), layout=layout, format=format, stride=stride)
+
+    def enable_timing(self):
+        """
+        Starts measuring the time spent in each phase of the simulation ("integrate", "derivs", "diagnostics", "positions", "export", "render_frame")
+        and returns the PhaseTimer, whose report() gives the totals; the timing is disabled again with disable_timing()
+        """
+        self.timer = PhaseTimer()
+        return self.timer
+
+    def disable_timing(self):
+        self.timer = NULL_TIMER
+
+    def scenePositions(self):
+        """ Builds the [body, coordinate, sample] array of positions used by the display functions from the body arrays"""
         self.positions = np.zeros([2, 3, self.numIterations])
         self.positions[0,:3:2, :] = self.body1_array
         self.positions[1,:3:2, :] = self.body2_array
         #print(self.positions)
 
         self.numOfBodies = 2
-        
+        self.pyramid = None #as posições foram recriadas, então a pirâmide de resoluções é refeita por show()
 
+    
 
-        show(self, dtStepPerFrame, use_lines)
+class PendulumEnsemble():
+    """
+    Creates a set of independent double pendulums that are integrated together, as used in studies of the sensitivity to the initial conditions.
+    Every input may be a number or an array; they are broadcast to a common shape, which is also the shape of the results.
+        - M1, M2: masses of the first and second bodies
+            float or array
+        - L1, L2: lengths of the first and second rods
+            float or array
+        - th1, th2: initial angles of the bodies (degrees)
+            float or array
+        - w1, w2: initial angular velocities of the bodies (degrees per second)
+            float or array
+        - G: Corresponds to the gravity value; when not provided, defaults to the value of the constant in the SI unit
+            numerical value as int or float
+
+    """
+    def __init__(self, M1, M2, L1, L2, th1, th2, w1 = 0, w2 = 0, G = 9.8):
+        arrays = np.broadcast_arrays(*[np.asarray(value, dtype=float) for value in (M1, M2, L1, L2, th1, w1, th2, w2)])
+        self.shape = arrays[0].shape
+        self.numOfPendulums = arrays[0].size
+        self.M1, self.M2, self.L1, self.L2, self.th1, self.w1, self.th2, self.w2 = [np.ascontiguousarray(array).reshape(-1) for array in arrays]
+        self.G = G
+
+    @classmethod
+    def angleGrid(cls, body1, body2, theta1, theta2, G = 9.8):
+        """
+        Creates an ensemble with the masses, lengths and angular velocities of body1 and body2 (CreateBodyPen objects) over every combination of the given initial angles.
+        The results have the shape [len(theta2), len(theta1)], so they can be shown directly with imshow.
+        """
+        th1, th2 = np.meshgrid(theta1, theta2)
+        return cls(body1.mass, body2.mass, body1.length, body2.length, th1, th2, body1.w, body2.w, G)
+
+    def derivs(self, t, state, pendulums = slice(None)):
+        """ Time derivatives of the [numOfPendulums, 4] state array (theta1, w1, theta2, w2) of the selected pendulums"""
+        M1, M2, L1, L2 = self.M1[pendulums], self.M2[pendulums], self.L1[pendulums], self.L2[pendulums]
+        dydx = np.empty_like(state)
+
+        dydx[:, 0] = state[:, 1]
+
+        delta = state[:, 2] - state[:, 0]
+        sinDelta, cosDelta = sin(delta), cos(delta)
+        sin1, sin2 = sin(state[:, 0]), sin(state[:, 2])
+
+        den1 = (M1+M2) * L1 - M2 * L1 * cosDelta * cosDelta
+        dydx[:, 1] = ((M2 * L1 * state[:, 1] * state[:, 1] * sinDelta * cosDelta
+                    + M2 * self.G * sin2 * cosDelta
+                    + M2 * L2 * state[:, 3] * state[:, 3] * sinDelta
+                    - (M1+M2) * self.G * sin1)
+                / den1)
+
+        dydx[:, 2] = state[:, 3]
+
+        den2 = (L2/L1) * den1
+        dydx[:, 3] = ((- M2 * L2 * state[:, 3] * state[:, 3] * sinDelta * cosDelta
+                    + (M1+M2) * self.G * sin1 * cosDelta
+                    - (M1+M2) * L1 * state[:, 1] * state[:, 1] * sinDelta
+                    - (M1+M2) * self.G * sin2)
+                / den2)
+
+        return dydx
+
+    def simulate(self, timeInterval, dt = 0.01, backend = 'auto', method = 'euler'):
+        """
+        Integrates all the pendulums within a given time range with a fixed step method, keeping only compact results:
+            - finalState: state (theta1, w1, theta2, w2) of each pendulum at the final time, in radians
+                array of shape [*shape, 4]
+            - flipTime: first time at which one of the bodies of each pendulum flips over (|theta| > 180 degrees), NaN when it never happens
+                array of shape [*shape]
+
+        Takes the same inputs as PendulumSim.simulate, except that the method must have a fixed step ("euler" or "rk4").
+        """
+        self.dt = dt
+        self.time = np.arange(timeInterval[0], timeInterval[1]+self.dt, self.dt)
+
+        integrator = getIntegrator(method, kinds=('first_order',))
+        if integrator.adaptive:
+            raise ValueError(f'The adaptive method "{method}" cannot be used with ensembles, whose pendulums share the same time steps')
+        backend = selectBackend(backend, method)
+
+        state = np.radians(np.stack([self.th1, self.w1, self.th2, self.w2], axis=1))
+        flipTime = np.where((np.abs(state[:, 0]) > np.pi) | (np.abs(state[:, 2]) > np.pi), self.time[0], np.nan)
+
+        if backend == 'numba':
+            _, ensembleEulerLoop = numbaKernels()
+            ensembleEulerLoop(state, self.time, self.dt, self.M1, self.M2, self.L1, self.L2, self.G, flipTime)
+        else:
+            for start in range(0, self.numOfPendulums, ENSEMBLE_CHUNK):
+                pendulums = slice(start, start + ENSEMBLE_CHUNK)
+                chunk = state[pendulums]
+                chunkFlip = flipTime[pendulums]
+                derivs = lambda t, y: self.derivs(t, y, pendulums)
+                dchunk = derivs(self.time[0], chunk)
+                for i in range(1, len(self.time)):
+                    chunk[:], dchunk = integrator.function(derivs, self.time[i - 1], chunk, dchunk, dt)
+                    flipped = np.isnan(chunkFlip) & ((np.abs(chunk[:, 0]) > np.pi) | (np.abs(chunk[:, 2]) > np.pi))
+                    chunkFlip[flipped] = self.time[i]
+
+        self.finalState = state.reshape(self.shape + (4,))
+        self.flipTime = flipTime.reshape(self.shape)
+        return self.finalState, self.flipTime
 
-    
 
 if __name__ == "__main__":
     from body import CreateBodyPen
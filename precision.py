@@ -0,0 +1,112 @@
+import numpy as np
+
+class PrecisionPolicy():
+    """
+    Floating point types used by each part of a gravitational simulation.
+        - name: name used to select the policy in GravitySim
+            str
+        - stateDtype: type of the positions, velocities and accelerations integrated at each step
+            numpy dtype
+        - forceDtype: type in which the forces are evaluated (the positions and masses are converted to it; the Barnes-Hut tree itself is built in at least float64)
+            numpy dtype
+        - storeDtype: type of the stored samples
+            numpy dtype
+
+    """
+
+    def __init__(self, name, stateDtype, forceDtype, storeDtype):
+        self.name = name
+        self.stateDtype = np.dtype(stateDtype)
+        self.forceDtype = np.dtype(forceDtype)
+        self.storeDtype = np.dtype(storeDtype)
+
+#Policies available to the simulations, by name:
+#"double" keeps everything in float64; "mixed" integrates in float64 but evaluates the forces and stores the samples in float32
+#(half of the memory and bandwidth for large runs, whose cost is in the forces); "single" uses float32 everywhere;
+#"extended" uses the long double of the platform (80 bits on x86, but only float64 on some platforms), slow, used as reference for the rounding errors
+PRECISIONS = {
+    'double': PrecisionPolicy('double', np.float64, np.float64, np.float64),
+    'mixed': PrecisionPolicy('mixed', np.float64, np.float32, np.float32),
+    'single': PrecisionPolicy('single', np.float32, np.float32, np.float32),
+    'extended': PrecisionPolicy('extended', np.longdouble, np.longdouble, np.longdouble),
+}
+
+def getPrecision(name):
+    """ Returns the precision policy registered under the given name"""
+    if name not in PRECISIONS:
+        raise ValueError(f'Unknown precision "{name}", use one of: {", ".join(PRECISIONS)}')
+    return PRECISIONS[name]
+
+def twoSum(a, b):
+    """ Sum of two arrays and its exact rounding error (Knuth), so that a + b = total + error"""
+    total = a + b
+    bVirtual = total - a
+    return total, (a - (total - bVirtual)) + (b - bVirtual)
+
+class CompensatedArray():
+    """
+    Array that carries, next to its value, the rounding errors of the sums that produced it (compensated, or Kahan, summation).
+    Adding a small increment to a large value normally loses the low bits of the increment; here they are kept in error and added back in the following sums,
+    so the accumulated value is as accurate as if it had about twice the precision.
+
+    The integrators of the registry work on it without changes: sums with arrays or with other compensated arrays are compensated, products by
+    numbers scale both parts (as in the drift x + v*dt), and NumPy functions (e.g. the force evaluation) receive the value.
+
+    Takes the following variables as initialization values:
+        - value: Rounded value of the array
+            array
+        - error: Compensation of each element; zero when not provided
+            array
+
+    """
+
+    #NumPy operators defer to the reflected methods of this class
+    __array_ufunc__ = None
+
+    def __init__(self, value, error = None):
+        self.value = value
+        self.error = np.zeros_like(value) if error is None else error
+
+    @classmethod
+    def stack(cls, arrays):
+        """ Stacks compensated arrays along a new first axis, as np.stack"""
+        return cls(np.stack([array.value for array in arrays]), np.stack([array.error for array in arrays]))
+
+    def __add__(self, other):
+        if isinstance(other, CompensatedArray):
+            total, error = twoSum(self.value, other.value)
+            error = error + self.error + other.error
+        else:
+            total, error = twoSum(self.value, other)
+            error = error + self.error
+        #renormalization, so the error stays below the last bit of the value
+        value = total + error
+        return CompensatedArray(value, error - (value - total))
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return CompensatedArray(-self.value, -self.error)
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __mul__(self, factor):
+        return CompensatedArray(self.value * factor, self.error * factor)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, divisor):
+        return CompensatedArray(self.value / divisor, self.error / divisor)
+
+    def __getitem__(self, index):
+        return CompensatedArray(self.value[index], self.error[index])
+
+    def __array__(self, dtype = None, copy = None):
+        return np.asarray(self.value, dtype=dtype)
+
+    def __len__(self):
+        return len(self.value)
@@ -0,0 +1,59 @@
+import time
+from contextlib import contextmanager, nullcontext
+
+class PhaseTimer():
+    """
+    Accumulates the wall time spent in each phase of a simulation (e.g. "force", "integrate", "store").
+    Phases may be nested: the time of a phase excludes the time of the phases started inside it, so the totals add up to the instrumented time.
+
+    Enable it on a simulation with scene.timer = PhaseTimer() (or scene.enable_timing()), run it, and read scene.timer.report().
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self.calls = {}
+        self.stack = []
+
+    @contextmanager
+    def phase(self, name):
+        """ Context manager that adds the time spent inside it to the given phase"""
+        self.stack.append(0.0) #time of the phases nested in this one
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self.stack.pop()
+            self.totals[name] = self.totals.get(name, 0.0) + elapsed - nested
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if self.stack:
+                self.stack[-1] += elapsed
+
+    def reset(self):
+        self.totals.clear()
+        self.calls.clear()
+
+    def report(self):
+        """ Returns {phase: {'seconds': exclusive time, 'calls': number of calls}}, from the slowest phase to the fastest"""
+        return {name: {'seconds': self.totals[name], 'calls': self.calls[name]} for name in sorted(self.totals, key=self.totals.get, reverse=True)}
+
+    def __str__(self):
+        total = sum(self.totals.values())
+        lines = [f'{"phase":>12} {"time [s]":>10} {"share":>7} {"calls":>9}']
+        for name, values in self.report().items():
+            lines.append(f'{name:>12} {values["seconds"]:10.4f} {values["seconds"] / total if total else 0:7.1%} {values["calls"]:9d}')
+        return '\n'.join(lines)
+
+class NullTimer():
+    """ Timer used while timing is disabled; its phases do nothing"""
+
+    context = nullcontext()
+
+    def phase(self, name):
+        return self.context
+
+    def report(self):
+        return {}
+
+#Shared instance used by every simulation without a timer
+NULL_TIMER = NullTimer()
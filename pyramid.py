@@ -0,0 +1,100 @@
+import numpy as np
+
+#Each level of the pyramid keeps one of every DECIMATION samples of the level below it
+DECIMATION = 4
+
+#Levels are added until the coarsest one has at most this number of samples
+MIN_SAMPLES = 512
+
+#Largest size in bytes of the first decimated level, which is kept in memory; longer trajectories skip levels until it fits
+LEVEL_BYTES = 2**27
+
+#Number of samples read at once from the full resolution trajectory (keeps disk-backed trajectories out of memory)
+SCAN_CHUNK = 4096
+
+#Maximum number of points of each body used to draw a trail
+TRAIL_POINTS = 200
+
+def largestStep(positions):
+    """ Largest distance moved by a body between two consecutive samples of a [body, coordinate, sample] array (bodies removed by collisions are NaN and ignored)"""
+    if positions.shape[2] < 2:
+        return 0.0
+    steps = np.sqrt(np.sum(np.diff(positions, axis=2)**2, axis=1))
+    return float(np.max(steps, initial=0.0, where=~np.isnan(steps)))
+
+class TrajectoryPyramid():
+    """
+    Multi-resolution copy of a trajectory, used to display long simulations without reading all of their samples.
+    Level 0 is the trajectory itself and each other level holds, in memory, the samples whose index is a multiple of its scale (scales[level]).
+    The first decimated level takes one of every factor samples, or of every factor**k samples when needed to fit in maxBytes (so a long, disk-backed
+    trajectory is never copied to memory), and each of the next ones takes one of every factor samples of the previous one.
+    The maximum absolute coordinate (extent) and the largest distance moved by a body between two consecutive samples of level 0 are found
+    in the same single pass that builds the first decimated level; the distances of the other levels come from their in-memory copies.
+
+    Takes the following variables as initialization values:
+        - positions: Positions of the bodies over time, possibly a view of disk-backed samples
+            [body, coordinate, sample] array
+        - factor: Decimation between two consecutive levels
+            int
+        - minSamples: Levels are added until the coarsest one has at most this number of samples
+            int
+        - maxBytes: Largest size in bytes of the first decimated level
+            int
+
+    """
+
+    def __init__(self, positions, factor = DECIMATION, minSamples = MIN_SAMPLES, maxBytes = LEVEL_BYTES):
+        self.factor = factor
+        self.numSamples = positions.shape[2]
+        self.levels = [positions]
+        self.scales = [1]
+
+        sampleBytes = positions.shape[0] * positions.shape[1] * positions.dtype.itemsize
+        scale = factor
+        while scale < self.numSamples and -(-self.numSamples // scale) * sampleBytes > maxBytes:
+            scale *= factor
+        first = None
+        if self.numSamples > minSamples:
+            first = np.empty(positions.shape[:2] + (-(-self.numSamples // scale),), positions.dtype)
+        self.extent = 0.0
+        self.steps = [0.0] #largest distance moved by a body between two consecutive samples of each level
+        previous = None
+        for start in range(0, self.numSamples, SCAN_CHUNK):
+            block = np.asarray(positions[:, :, start:start+SCAN_CHUNK])
+            self.extent = max(self.extent, float(np.nanmax(np.abs(block))))
+            self.steps[0] = max(self.steps[0], largestStep(block if previous is None else np.concatenate([previous, block], axis=2)))
+            previous = block[:, :, -1:]
+            if first is not None:
+                picked = block[:, :, -start % scale::scale] #samples of the chunk whose index is a multiple of the scale
+                first[:, :, -(-start // scale):-(-start // scale) + picked.shape[2]] = picked
+
+        if first is not None:
+            self.levels.append(first)
+            self.scales.append(scale)
+            while self.levels[-1].shape[2] > minSamples:
+                self.levels.append(np.ascontiguousarray(self.levels[-1][:, :, ::factor]))
+                self.scales.append(self.scales[-1] * factor)
+            self.steps += [largestStep(level) for level in self.levels[1:]]
+
+    def sample(self, index):
+        """ Positions ([body, coordinate]) of one sample, read from the coarsest level that contains it"""
+        level = 0
+        while level + 1 < len(self.levels) and index % self.scales[level + 1] == 0:
+            level += 1
+        return self.levels[level][:, :, index // self.scales[level]]
+
+    def trail(self, index, length, maxPoints = TRAIL_POINTS, tolerance = 0):
+        """
+        Positions ([body, coordinate, point]) of the length samples before the given one, ending at it.
+        They are read from the coarsest level whose bodies move at most tolerance between two consecutive points (e.g. the size of a few pixels
+        at the current zoom), or from a coarser one when needed to give at most about maxPoints points, so the cost does not depend on the length of the trail.
+        """
+        level = 0
+        while level + 1 < len(self.levels) and (length > maxPoints * self.scales[level] or self.steps[level + 1] <= tolerance):
+            level += 1
+        scale = self.scales[level]
+        start = -(-max(index - length, 0) // scale)
+        points = self.levels[level][:, :, start:index // scale + 1]
+        if index % scale:
+            points = np.concatenate([points, self.levels[0][:, :, index:index+1]], axis=2)
+        return points
@@ -0,0 +1,172 @@
+import os
+import numpy as np
+
+#Quantities stored for each saved sample of a simulation
+QUANTITIES = ('positions', 'velocities', 'accelerations')
+
+#Number of samples kept in memory before they are written to the disk-backed arrays
+CHUNK_SIZE = 256
+
+class TrajectoryStore():
+    """
+    Stores the saved samples of a simulation in time-major arrays of shape [numSamples, numOfBodies, 3], so each sample is written as one contiguous block.
+
+    Takes the following variables as initialization values:
+        - time: Times of the samples that will be stored
+            array of floats
+        - numOfBodies: Number of bodies of the simulation
+            int
+        - directory: Folder where the samples are written as memory-mapped .npy files (one per quantity, plus time.npy); when not provided, the samples are kept in memory
+            str
+        - chunkSize: Number of samples buffered in memory before each write to disk
+            int
+        - dtype: Floating point type of the stored values
+            numpy dtype
+
+    """
+
+    def __init__(self, time, numOfBodies, directory = None, chunkSize = CHUNK_SIZE, dtype = float):
+        self.time = np.asarray(time)
+        self.directory = directory
+        self.numSamples = len(self.time)
+        self.numSaved = 0
+        shape = (self.numSamples, numOfBodies, 3)
+
+        if directory is None:
+            self.data = {quantity: np.zeros(shape, dtype) for quantity in QUANTITIES}
+            self.buffer = None
+        else:
+            os.makedirs(directory, exist_ok=True)
+            np.save(os.path.join(directory, 'time.npy'), self.time)
+            self.data = {quantity: np.lib.format.open_memmap(os.path.join(directory, f'{quantity}.npy'), mode='w+', dtype=dtype, shape=shape) for quantity in QUANTITIES}
+            self.buffer = {quantity: np.empty((chunkSize, numOfBodies, 3), dtype) for quantity in QUANTITIES}
+            self.numBuffered = 0
+
+    @classmethod
+    def open(cls, directory, mode = 'r', numSaved = None, chunkSize = CHUNK_SIZE):
+        """
+        Opens the samples previously written to the given folder without loading them into memory.
+        With mode "r+", new samples can be appended after the first numSaved ones (by default, all of them); the samples after them stay in the files
+        until the first call to extend, which replaces them.
+        """
+        store = cls.__new__(cls)
+        store.directory = directory
+        store.time = np.load(os.path.join(directory, 'time.npy'))
+        store.numSaved = len(store.time) if numSaved is None else numSaved
+        store.time = store.time[:store.numSaved]
+        store.numSamples = store.numSaved
+        store.data = {quantity: np.load(os.path.join(directory, f'{quantity}.npy'), mmap_mode=mode)[:store.numSaved] for quantity in QUANTITIES}
+        store.buffer = None
+
+        if mode == 'r+':
+            shape = store.data['positions'].shape[1:]
+            store.buffer = {quantity: np.empty((chunkSize,) + shape, store.data[quantity].dtype) for quantity in QUANTITIES}
+            store.numBuffered = 0
+        return store
+
+    def extend(self, time):
+        """
+        Makes room for the samples of the given times after the existing ones. With a storage folder, the .npy files are resized, which needs every other view
+        of the stored arrays to be released first (a mapped file cannot be truncated or replaced on Windows).
+        """
+        self.flush()
+        self.time = np.concatenate([self.time, time])
+        self.numSamples = len(self.time)
+        if self.directory is not None:
+            np.save(os.path.join(self.directory, 'time.npy'), self.time)
+        self.resize(self.numSamples)
+
+    def dropUnsaved(self):
+        """
+        Drops the samples planned after the saved ones, e.g. when the run stopped with an error, so the stored arrays end at the last saved sample
+        and extend adds the new samples right after it (the .npy files keep their length until then; time.npy is rewritten with the saved times).
+        """
+        self.flush()
+        self.time = self.time[:self.numSaved]
+        self.numSamples = self.numSaved
+        self.data = {quantity: array[:self.numSaved] for quantity, array in self.data.items()}
+        if self.directory is not None:
+            np.save(os.path.join(self.directory, 'time.npy'), self.time)
+
+    def resize(self, numSamples):
+        """ Changes the number of samples of the stored arrays, keeping the saved ones (the .npy files are resized in place)"""
+        for quantity in QUANTITIES:
+            shape = (numSamples,) + self.data[quantity].shape[1:]
+            dtype = self.data[quantity].dtype
+            if self.directory is None:
+                resized = np.zeros(shape, dtype)
+                resized[:self.numSaved] = self.data[quantity][:self.numSaved]
+                self.data[quantity] = resized
+            else:
+                #the store drops its own mapping of the file before it is truncated or replaced
+                self.data[quantity] = None
+                self.data[quantity] = resizeNpy(os.path.join(self.directory, f'{quantity}.npy'), shape, dtype)
+
+    def append(self, positions, velocities, accelerations):
+        """ Adds a new sample, given as [numOfBodies, 3] arrays, after the last one stored"""
+        if self.buffer is None:
+            target, index = self.data, self.numSaved
+        else:
+            target, index = self.buffer, self.numBuffered
+            self.numBuffered += 1
+
+        target['positions'][index] = positions
+        target['velocities'][index] = velocities
+        target['accelerations'][index] = accelerations
+        self.numSaved += 1
+
+        if self.buffer is not None and self.numBuffered == len(self.buffer['positions']):
+            self.flush()
+
+    def flush(self):
+        """ Writes the buffered samples to disk"""
+        if self.buffer is None:
+            return
+        if self.numBuffered:
+            start = self.numSaved - self.numBuffered
+            for quantity in QUANTITIES:
+                self.data[quantity][start:self.numSaved] = self.buffer[quantity][:self.numBuffered]
+            self.numBuffered = 0
+        for quantity in QUANTITIES:
+            self.data[quantity].flush()
+
+    def bodyMajor(self, quantity):
+        """ Returns a [numOfBodies, 3, numSamples] view of a stored quantity, which is the layout used by the simulation classes"""
+        return self.data[quantity].transpose(1, 2, 0)
+
+def resizeNpy(path, shape, dtype):
+    """ Changes the shape along the first axis of a C-ordered .npy file, rewriting only its header and its length, and returns it memory-mapped for writing"""
+    with open(path, 'r+b') as file:
+        version = np.lib.format.read_magic(file)
+        oldShape = np.lib.format.read_array_header_1_0(file)[0] if version == (1, 0) else np.lib.format.read_array_header_2_0(file)[0]
+        offset = file.tell()
+
+        #The headers written by NumPy are padded so that the first dimension can grow without changing their length
+        header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': tuple(shape)}
+        file.seek(0)
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(file, header)
+        else:
+            np.lib.format.write_array_header_2_0(file, header)
+
+        if file.tell() == offset:
+            file.truncate(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            return np.load(path, mmap_mode='r+')
+
+        #Header of a different length: restore it and copy the data to a new file
+        file.seek(0)
+        header['shape'] = oldShape
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(file, header)
+        else:
+            np.lib.format.write_array_header_2_0(file, header)
+
+    old = np.load(path, mmap_mode='r')
+    resized = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=dtype, shape=shape)
+    keep = min(len(old), shape[0])
+    for start in range(0, keep, CHUNK_SIZE):
+        resized[start:min(start + CHUNK_SIZE, keep)] = old[start:min(start + CHUNK_SIZE, keep)]
+    resized.flush()
+    del old, resized
+    os.replace(path + '.tmp', path)
+    return np.load(path, mmap_mode='r+')
@@ -0,0 +1,167 @@
+import os
+import pickle
+import inspect
+import numpy as np
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from forces import minimumSeparation, PAIRS_PER_BLOCK
+
+def trajectoryPositions(scene):
+    """ Stored positions of the bodies as a time-major [sample, body, coordinate] array, as written by the export methods (x and y only for a pendulum)"""
+    if hasattr(scene, 'body1_array'):
+        return np.stack([scene.body1_array.T, scene.body2_array.T], axis=1)
+    return scene.store.data['positions'][:scene.store.numSaved]
+
+def finalPositions(scene):
+    """ Positions of the bodies at the last stored sample ([body, coordinate])"""
+    return np.array(trajectoryPositions(scene)[-1])
+
+def finalVelocities(scene):
+    """ Velocities of the bodies at the last stored sample ([body, coordinate]), or the final state (theta1, w1, theta2, w2) of a pendulum"""
+    if hasattr(scene, 'y'):
+        return np.array(scene.y[-1])
+    return np.array(scene.velocities[:, :, -1])
+
+def energyDrift(scene):
+    """ Relative change of the total energy between the first and the last samples"""
+    initial = scene.energy(0)
+    return (scene.energy(-1) - initial) / abs(initial)
+
+def minSeparation(scene):
+    """ Smallest distance between two bodies over all the stored samples (bodies removed by collisions are NaN and ignored)"""
+    positions = trajectoryPositions(scene)
+    numOfBodies = positions.shape[1]
+    if numOfBodies**2 > PAIRS_PER_BLOCK:
+        return min(minimumSeparation(sample[~np.isnan(sample[:, 0])]) for sample in positions)
+
+    #All pairs of a block of samples at once
+    first, second = np.triu_indices(numOfBodies, 1)
+    samplesPerBlock = max(1, PAIRS_PER_BLOCK // max(len(first), 1))
+    closest = np.inf
+    for start in range(0, len(positions), samplesPerBlock):
+        block = np.asarray(positions[start:start + samplesPerBlock])
+        distances = np.sqrt(np.sum((block[:, first] - block[:, second])**2, axis=2))
+        closest = min(closest, float(np.min(distances, initial=np.inf, where=~np.isnan(distances))))
+    return closest
+
+#Reductions that can be requested by name; any picklable function that receives the simulated scene may also be used
+REDUCTIONS = {
+    'final_positions': finalPositions,
+    'final_velocities': finalVelocities,
+    'energy_drift': energyDrift,
+    'min_separation': minSeparation,
+}
+
+def expandGrid(parameterGrid):
+    """ Turns a dict of {name: list of values} into the list of all combinations, or returns the given list of dicts"""
+    if isinstance(parameterGrid, dict):
+        names = list(parameterGrid)
+        return [dict(zip(names, values)) for values in product(*parameterGrid.values())]
+    return list(parameterGrid)
+
+def runScenario(sceneFactory, params, simulateArgs, reductions, progress = False):
+    """
+    Creates one scene with the factory, simulates it and returns only the requested reductions.
+    The factory receives the parameters as keyword arguments and returns either a scene or a tuple (scene, dict of arguments for simulate).
+    """
+    scene = sceneFactory(**params)
+    args = dict(simulateArgs)
+    if isinstance(scene, tuple):
+        scene, extraArgs = scene
+        args.update(extraArgs)
+    if 'progress' in inspect.signature(scene.simulate).parameters:
+        args.setdefault('progress', progress)
+    scene.simulate(**args)
+
+    results = {}
+    for reduction in reductions:
+        function = REDUCTIONS[reduction] if isinstance(reduction, str) else reduction
+        results[reduction if isinstance(reduction, str) else function.__name__] = function(scene)
+    return results
+
+def loadCheckpoint(checkpoint):
+    """
+    Reads the records saved in a checkpoint file and returns them as {index: (params, results)}, together with the size in bytes of the complete records.
+    An incomplete last record, left by an interruption, is ignored (sweep truncates the file there before appending).
+    """
+    done = {}
+    end = 0
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return done, end
+    with open(checkpoint, 'rb') as file:
+        while True:
+            try:
+                index, params, results = pickle.load(file)
+            except (EOFError, pickle.UnpicklingError, ValueError):
+                break
+            done[index] = (params, results)
+            end = file.tell()
+    return done, end
+
+def sameParams(params, other):
+    """ Whether two sets of parameters are equal, compared through their pickled form (which also works for NumPy arrays)"""
+    return pickle.dumps(params) == pickle.dumps(other)
+
+def sweep(sceneFactory, parameterGrid, simulateArgs, reductions = ('final_positions',), workers = None, checkpoint = None, progress = False):
+    """
+    Runs one simulation for each combination of parameters in a pool of worker processes.
+
+    Takes the following variables as input:
+        - sceneFactory: Function (defined at the top level of a module, so it can be sent to the workers) that receives the parameters as keyword arguments
+          and returns a GravitySim/PendulumSim object, or a tuple (scene, dict of arguments for simulate) to also vary arguments like dt
+        - parameterGrid: dict with a list of values for each parameter (all combinations are run), or a list of dicts with the parameters of each run
+        - simulateArgs: Arguments passed to the simulate method of every scene
+            dict, e.g. {'timeInterval': [0, 10], 'dt': 1e-3}
+        - reductions: Results kept from each run; names from REDUCTIONS ("final_positions", "final_velocities", "energy_drift", "min_separation") or functions of the scene
+        - workers: Number of processes; when not provided, one per core
+            int
+        - checkpoint: File where the parameters and the result of each run are saved as soon as it finishes; when the sweep is run again, the runs already saved
+          with the same parameters are skipped (runs whose parameters changed in the grid are run again)
+            str
+        - progress: Whether the progress bar of each run is shown (the progress of the sweep is always shown)
+            bool
+
+    Returns a list, in the order of the parameter grid, with a dict per run holding 'params' and the requested reductions. When a run raises an exception,
+    the other runs go on, and its dict holds 'params' and 'error' (the exception) instead; failed runs are not saved in the checkpoint, so they are run again.
+    """
+    from tqdm import tqdm
+
+    scenarios = expandGrid(parameterGrid)
+    saved, end = loadCheckpoint(checkpoint)
+    done = {index: results for index, (params, results) in saved.items() if index < len(scenarios) and sameParams(params, scenarios[index])}
+    pending = [index for index in range(len(scenarios)) if index not in done]
+    if checkpoint is not None and os.path.exists(checkpoint):
+        #new records are appended after the last complete one, overwriting a record left incomplete by an interruption
+        with open(checkpoint, 'r+b') as file:
+            file.truncate(end)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(runScenario, sceneFactory, scenarios[index], simulateArgs, reductions, progress): index for index in pending}
+        for future in tqdm(as_completed(futures), total=len(scenarios), initial=len(scenarios) - len(pending), desc="Sweeping"):
+            index = futures[future]
+            try:
+                done[index] = future.result()
+            except Exception as error:
+                done[index] = {'error': error}
+                continue
+            if checkpoint is not None:
+                with open(checkpoint, 'ab') as file:
+                    pickle.dump((index, scenarios[index], done[index]), file)
+
+    return [dict(params=scenarios[index], **done[index]) for index in range(len(scenarios))]
+
+def perturbedSolarSystem(earthVelocity = 6.3895702139037430, G = 0.00011855835621470008):
+    """ Example factory: Sun, Earth and Jupiter with a given initial velocity of the Earth"""
+    from body import CreateBodyGrav
+    from gravitySim import GravitySim
+
+    sol = CreateBodyGrav(333000,position_vector=[0,0,0],velocity_vector=[0,0,0],label = 'Sol')
+    terra = CreateBodyGrav(1,position_vector=[0.9832553475935829,0,0],velocity_vector=[0,earthVelocity,0],label = 'Terra')
+    jupiter = CreateBodyGrav(317.83,position_vector=[4.950501336898395,0,0],velocity_vector=[0,2.894186310160428,0],label = 'Júpiter')
+    return GravitySim([sol, terra, jupiter], G = G)
+
+if __name__ == "__main__":
+    results = sweep(perturbedSolarSystem, {'earthVelocity': np.linspace(5.5, 7.5, 8).tolist()}, {'timeInterval': [0, 10], 'dt': 1e-3},
+                    reductions=('energy_drift', 'min_separation'))
+    for result in results:
+        print(result['params'], f"energy drift = {result['energy_drift']:.2e}", f"min separation = {result['min_separation']:.3f}")